@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""Stand-in backend for the cutover benchmark.
+
+Like the servers in samples/, it listens on a random port, writes a pid file
+and a <pid>.port file, and stops gracefully on SIGUSR1: it stops accepting
+connections, finishes the requests in flight and exits. Each request takes
+--latency seconds, so there is something in flight during a cutover.
+"""
+from __future__ import with_statement
+
+import BaseHTTPServer
+from optparse import OptionParser
+import os
+import signal
+import SocketServer
+import sys
+import threading
+import time
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        body = "Hello World (zdd bench backend %s)\n" % os.getpid()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # Keep request threads non-daemonic so a graceful stop can wait for them.
+    daemon_threads = False
+    request_queue_size = 128
+
+def daemonize():
+    if os.fork():
+        os._exit(0)
+    os.setsid()
+    if os.fork():
+        os._exit(0)
+
+    null = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(null, fd)
+
+def remove_file_if_ours(filename, pid):
+    try:
+        with file(filename, 'r') as pid_file:
+            if pid_file.read().strip() != str(pid):
+                return
+        os.unlink(filename)
+    except (IOError, OSError):
+        pass
+
+def main(argv):
+    parser = OptionParser()
+    parser.add_option("--latency", type="float", default=0.0, help="Seconds each request takes. [default %default]")
+    parser.add_option("--startup", type="float", default=0.0, help="Seconds to wait before listening. [default %default]")
+    parser.add_option("--pid-file", default=os.environ.get("ZDD_PID_FILE", "backend.pid"), help="[default %default]")
+    parser.add_option("--daemon", action="store_true", default=False, help="Detach from the terminal.")
+    options, args = parser.parse_args(argv)
+
+    pid_file = os.path.abspath(options.pid_file)
+
+    if options.daemon:
+        daemonize()
+
+    time.sleep(options.startup)
+
+    server = Server(("127.0.0.1", 0), Handler)
+    server.latency = options.latency
+
+    pid = os.getpid()
+    port_file = os.path.join(os.path.dirname(pid_file), "%s.port" % pid)
+    with file(port_file, 'w') as port_out:
+        port_out.write(str(server.server_address[1]))
+    with file(pid_file, 'w') as pid_out:
+        pid_out.write(str(pid))
+
+    stopping = []
+    signal.signal(signal.SIGUSR1, lambda signum, frame: stopping.append(signum))
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+
+    serve_thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05})
+    serve_thread.start()
+
+    # Signals are only delivered to the main thread, so it waits for them here.
+    while not stopping:
+        time.sleep(0.05)
+
+    server.shutdown()
+    server.server_close()
+    for thread in threading.enumerate():
+        if thread is not threading.current_thread():
+            thread.join()
+
+    os.unlink(port_file)
+    remove_file_if_ours(pid_file, pid)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
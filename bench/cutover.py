@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+"""Measure what clients see while zdd deploys.
+
+Starts the stand-in backend (backend.py) behind nginx, or behind proxy.py
+when nginx isn't installed, keeps it busy with a closed-loop load
+generator, and runs deploy() repeatedly. For each deploy it reports the
+failed connections, 5xx responses and latency of requests that started in
+a window around the cutover, so runs can be compared to catch regressions
+in cutover quality.
+
+  $ python bench/cutover.py --cycles 10 --concurrency 16 --latency 0.01
+"""
+from __future__ import with_statement
+
+import httplib
+from optparse import OptionParser
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from zdd.deploy import deploy, read_int_file, read_int_list_file, check_pid
+from zdd.report import Timeline
+from zdd.stats import percentile
+
+DEPLOY_CONF = """\
+[nginx]
+template: ./nginx.conf.template
+pid_file: ./nginx.pid
+command: %(nginx_command)s
+
+[service:backend]
+pid_file: backend.pid
+start: %(python)s %(bench_dir)s/backend.py --daemon --latency %(latency)s --startup %(startup)s
+stop: kill -USR1
+replicas: %(replicas)s
+"""
+
+NGINX_TEMPLATE = """\
+pid {nginx_pid_filename};
+error_log %(workspace)s/error.log notice;
+
+events {}
+
+http {
+    access_log off;
+    client_body_temp_path %(workspace)s/client_body;
+    proxy_temp_path %(workspace)s/proxy;
+    fastcgi_temp_path %(workspace)s/fastcgi;
+    uwsgi_temp_path %(workspace)s/uwsgi;
+    scgi_temp_path %(workspace)s/scgi;
+
+    upstream backend {
+        {backend:servers}
+    }
+
+    server {
+        listen 127.0.0.1:%(port)s;
+        location / {
+            proxy_pass http://backend;
+        }
+    }
+}
+"""
+
+REQUEST_TIMEOUT = 10.0
+
+def find_nginx():
+    for directory in os.environ.get("PATH", "").split(os.pathsep):
+        candidate = os.path.join(directory, "nginx")
+        if os.access(candidate, os.X_OK):
+            return candidate
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+class LoadGenerator(object):
+    """Closed loop: each client sends its next request as soon as the last one finishes."""
+
+    def __init__(self, port, concurrency):
+        self.port = port
+        self.concurrency = concurrency
+        self.results = []
+        self.lock = threading.Lock()
+        self.running = False
+        self.threads = []
+
+    def request(self):
+        connection = httplib.HTTPConnection("127.0.0.1", self.port, timeout=REQUEST_TIMEOUT)
+        try:
+            try:
+                connection.request("GET", "/")
+                response = connection.getresponse()
+                response.read()
+                return response.status
+            except (socket.error, httplib.HTTPException):
+                return None
+        finally:
+            connection.close()
+
+    def client(self):
+        while self.running:
+            start = time.time()
+            status = self.request()
+            end = time.time()
+            with self.lock:
+                self.results.append((start, end - start, status))
+
+    def start(self):
+        self.running = True
+        self.threads = [threading.Thread(target=self.client) for _ in xrange(self.concurrency)]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.running = False
+        for thread in self.threads:
+            thread.join()
+
+    def between(self, start, end):
+        with self.lock:
+            return [result for result in self.results if start <= result[0] < end]
+
+class WindowStats(object):
+    def __init__(self, results):
+        self.requests = len(results)
+        self.failed = len([status for _, _, status in results if status is None])
+        self.errors = len([status for _, _, status in results if status is not None and status >= 500])
+        latencies = [latency for _, latency, _ in results]
+        self.p50 = percentile(latencies, 50)
+        self.p99 = percentile(latencies, 99)
+        self.max = max(latencies) if latencies else None
+
+def format_ms(seconds):
+    if seconds is None:
+        return "-"
+    return "%.1fms" % (seconds * 1000)
+
+def format_row(label, stats, seconds=None):
+    return "%-10s %9s %9d %7d %6d %9s %9s %9s" % (
+        label, "%.2fs" % seconds if seconds is not None else "-", stats.requests, stats.failed, stats.errors,
+        format_ms(stats.p50), format_ms(stats.p99), format_ms(stats.max))
+
+def write_workspace(workspace, options, port, nginx_command):
+    values = {
+        "nginx_command": nginx_command,
+        "python": sys.executable,
+        "bench_dir": BENCH_DIR,
+        "latency": options.latency,
+        "startup": options.startup,
+        "replicas": options.replicas,
+        "workspace": workspace,
+        "port": port,
+    }
+    with file(os.path.join(workspace, "deploy.conf"), 'w') as conf:
+        conf.write(DEPLOY_CONF % values)
+    with file(os.path.join(workspace, "nginx.conf.template"), 'w') as template:
+        template.write(NGINX_TEMPLATE % values)
+
+def run_deploy(conf, timeline):
+    try:
+        deploy(conf, timeline)
+    except SystemExit:
+        timeline.finish(ok=False)
+    else:
+        timeline.finish(ok=True)
+
+def cutover_window(timeline, padding):
+    """The span from the first nginx reload to the end of the deploy, padded on both sides."""
+    reloads = [start for name, start, end in timeline.phases if name == "reload"]
+    start = min(reloads) if reloads else timeline.started
+    return start - padding, timeline.finished + padding, timeline.finished - start
+
+def shut_down(workspace):
+    pids = read_int_list_file(os.path.join(workspace, "backend.current.pid"))
+    nginx_pid = read_int_file(os.path.join(workspace, "nginx.pid"))
+    for pid in pids + [nginx_pid]:
+        if pid and check_pid(pid):
+            os.kill(pid, signal.SIGTERM)
+
+def main(argv):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--cycles", type="int", default=5, help="Number of deploys. [default %default]")
+    parser.add_option("--concurrency", type="int", default=8, help="Concurrent clients. [default %default]")
+    parser.add_option("--latency", type="float", default=0.005, help="Seconds each backend request takes. [default %default]")
+    parser.add_option("--startup", type="float", default=0.2, help="Seconds each backend takes to start. [default %default]")
+    parser.add_option("--replicas", default="1", help="Backend replicas. [default %default]")
+    parser.add_option("--window", type="float", default=0.5, help="Seconds before and after each cutover to measure. [default %default]")
+    parser.add_option("--pause", type="float", default=1.0, help="Seconds between deploys. [default %default]")
+    parser.add_option("--proxy", action="store_true", default=False, help="Use proxy.py even if nginx is installed.")
+    parser.add_option("--keep", action="store_true", default=False, help="Keep the workspace directory.")
+    options, args = parser.parse_args(argv)
+
+    nginx = None if options.proxy else find_nginx()
+    nginx_command = nginx or "%s %s" % (sys.executable, os.path.join(BENCH_DIR, "proxy.py"))
+
+    workspace = tempfile.mkdtemp(prefix="zdd-bench-")
+    port = free_port()
+    write_workspace(workspace, options, port, nginx_command)
+    conf = os.path.join(workspace, "deploy.conf")
+
+    print "Workspace %s, proxying with %s on port %s." % (workspace, nginx or "proxy.py", port)
+
+    load = LoadGenerator(port, options.concurrency)
+    timelines = []
+    try:
+        # The first deploy starts nginx, don't measure it.
+        first = Timeline()
+        run_deploy(conf, first)
+        if not first.ok:
+            print >>sys.stderr, "Initial deploy failed."
+            return 1
+
+        load.start()
+        time.sleep(options.pause)
+        for cycle in xrange(options.cycles):
+            timeline = Timeline()
+            run_deploy(conf, timeline)
+            timelines.append(timeline)
+            time.sleep(options.pause)
+        load.stop()
+    finally:
+        load.running = False
+        shut_down(workspace)
+        if not options.keep:
+            shutil.rmtree(workspace, ignore_errors=True)
+
+    print
+    print "%-10s %9s %9s %7s %6s %9s %9s %9s" % ("cutover", "duration", "requests", "failed", "5xx", "p50", "p99", "max")
+    windows = []
+    for cycle, timeline in enumerate(timelines):
+        start, end, duration = cutover_window(timeline, options.window)
+        windows.append((start, end))
+        label = "%d%s" % (cycle + 1, "" if timeline.ok else " FAILED")
+        print format_row(label, WindowStats(load.between(start, end)), duration)
+
+    in_windows = [result for result in load.results if any(start <= result[0] < end for start, end in windows)]
+    steady = [result for result in load.results if not any(start <= result[0] < end for start, end in windows)]
+    all_windows = WindowStats(in_windows)
+    print format_row("cutovers", all_windows)
+    print format_row("steady", WindowStats(steady))
+
+    failed_deploys = len([timeline for timeline in timelines if not timeline.ok])
+    if all_windows.failed or all_windows.errors or failed_deploys:
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
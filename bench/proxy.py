@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+"""Minimal stand-in for nginx, for running the cutover benchmark where nginx
+isn't installed.
+
+It understands just enough of nginx.conf for the benchmark template: the
+pid and error_log directives, upstream blocks with weighted servers and a
+server block that listens on a port and proxy_passes to an upstream. It
+mimics the process model zdd relies on: ``-c`` daemonizes a master which
+writes the pid file and forks a worker; on SIGHUP the master re-reads the
+config, forks a new worker and asks the old one to finish its requests and
+exit with SIGQUIT. ``-t -c`` only checks the config.
+"""
+from __future__ import with_statement
+
+import BaseHTTPServer
+import httplib
+import os
+import random
+import re
+import signal
+import socket
+import SocketServer
+import sys
+import threading
+import time
+
+UPSTREAM_TIMEOUT = 30.0
+TOKEN = re.compile(r"[{};]|[^\s{};]+")
+
+class ConfigError(Exception):
+    pass
+
+def parse_blocks(text):
+    """Parse nginx config syntax into a list of (name, args, children)
+    directives, where children is None for simple directives."""
+    text = re.sub(r"#[^\n]*", "", text)
+    tokens = TOKEN.findall(text)
+    position = [0]
+
+    def parse(depth):
+        directives = []
+        words = []
+        while position[0] < len(tokens):
+            token = tokens[position[0]]
+            position[0] += 1
+            if token == ";":
+                if not words:
+                    raise ConfigError("unexpected \";\"")
+                directives.append((words[0], words[1:], None))
+                words = []
+            elif token == "{":
+                if not words:
+                    raise ConfigError("unexpected \"{\"")
+                directives.append((words[0], words[1:], parse(depth + 1)))
+                words = []
+            elif token == "}":
+                if depth == 0 or words:
+                    raise ConfigError("unexpected \"}\"")
+                return directives
+            else:
+                words.append(token)
+
+        if depth != 0 or words:
+            raise ConfigError("unexpected end of file, expecting \";\" or \"}\"")
+        return directives
+
+    return parse(0)
+
+def find(directives, name):
+    return [directive for directive in directives if directive[0] == name]
+
+class Upstream(object):
+    def __init__(self, servers):
+        # [((host, port), weight)]
+        self.servers = servers
+
+    def pick_order(self):
+        """All servers, the first chosen at random by weight, then the rest
+        to fall back on if the first refuses the connection."""
+        total = sum(weight for address, weight in self.servers)
+        choice = random.uniform(0, total)
+        for index, (address, weight) in enumerate(self.servers):
+            choice -= weight
+            if choice <= 0:
+                break
+        rest = [address for address, weight in self.servers[:index] + self.servers[index + 1:]]
+        return [self.servers[index][0]] + rest
+
+class Config(object):
+    def __init__(self, filename):
+        self.filename = filename
+        with file(filename, 'r') as config_file:
+            directives = parse_blocks(config_file.read())
+
+        pid = find(directives, "pid")
+        self.pid_file = pid[0][1][0] if pid else "nginx.pid"
+        error_log = find(directives, "error_log")
+        self.error_log = error_log[0][1][0] if error_log else None
+
+        http = find(directives, "http")
+        if len(http) != 1 or http[0][2] is None:
+            raise ConfigError("expected one http block")
+        http = http[0][2]
+
+        upstreams = {}
+        for name, args, children in find(http, "upstream"):
+            servers = []
+            for server_name, server_args, _ in find(children or [], "server"):
+                host, port = server_args[0].rsplit(":", 1)
+                weight = 1
+                for arg in server_args[1:]:
+                    if arg.startswith("weight="):
+                        weight = int(arg[len("weight="):])
+                servers.append(((host, int(port)), weight))
+            if not servers:
+                raise ConfigError("no servers are inside upstream %s" % args[0])
+            upstreams[args[0]] = Upstream(servers)
+
+        servers = find(http, "server")
+        if len(servers) != 1:
+            raise ConfigError("expected one server block")
+        server = servers[0][2]
+
+        listen = find(server, "listen")
+        if not listen:
+            raise ConfigError("no listen directive")
+        address = listen[0][1][0]
+        host, port = address.rsplit(":", 1) if ":" in address else ("*", address)
+        self.listen = ("" if host == "*" else host, int(port))
+
+        proxy_pass = [args[0] for name, args, children in find(server, "location")
+                      for _, args, _ in find(children or [], "proxy_pass")]
+        if not proxy_pass:
+            raise ConfigError("no proxy_pass")
+        upstream_name = proxy_pass[0].split("://", 1)[-1].rstrip("/")
+        if upstream_name not in upstreams:
+            raise ConfigError("no upstream named %s" % upstream_name)
+        self.upstream = upstreams[upstream_name]
+
+class ProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def proxy(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else None
+
+        for host, port in self.server.upstream.pick_order():
+            connection = httplib.HTTPConnection(host, port, timeout=UPSTREAM_TIMEOUT)
+            try:
+                try:
+                    connection.request(self.command, self.path, body, {"Host": self.headers.get("Host", host)})
+                    response = connection.getresponse()
+                    data = response.read()
+                except (socket.error, httplib.HTTPException):
+                    # Like proxy_next_upstream error, try the next server.
+                    continue
+            finally:
+                connection.close()
+
+            self.send_response(response.status)
+            self.send_header("Content-Type", response.getheader("Content-Type", "text/plain"))
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+
+        self.send_error(502)
+
+    do_GET = do_HEAD = do_POST = do_PUT = do_DELETE = proxy
+
+    def log_message(self, format, *args):
+        pass
+
+class ProxyServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = False
+
+    def __init__(self, listen_socket, upstream):
+        BaseHTTPServer.HTTPServer.__init__(self, listen_socket.getsockname(), ProxyHandler, bind_and_activate=False)
+        self.socket.close()
+        self.socket = listen_socket
+        self.upstream = upstream
+
+def run_worker(listen_socket, config):
+    server = ProxyServer(listen_socket, config.upstream)
+    serve_thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05})
+    serve_thread.start()
+
+    quitting = []
+    signal.signal(signal.SIGQUIT, lambda signum, frame: quitting.append(signum))
+    signal.signal(signal.SIGTERM, lambda signum, frame: quitting.append(signum))
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    while not quitting:
+        time.sleep(0.05)
+
+    # Graceful shutdown: stop accepting, finish what is in flight.
+    server.shutdown()
+    for thread in threading.enumerate():
+        if thread is not threading.current_thread():
+            thread.join()
+    os._exit(0)
+
+class Master(object):
+    def __init__(self, config):
+        self.config = config
+        self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listen_socket.bind(config.listen)
+        self.listen_socket.listen(512)
+        self.workers = set()
+        self.signals = []
+
+    def log(self, message):
+        if not self.config.error_log:
+            return
+        with file(self.config.error_log, 'a') as error_log:
+            error_log.write("%s [notice] %s: %s\n" % (time.strftime("%Y/%m/%d %H:%M:%S"), os.getpid(), message))
+
+    def spawn_worker(self):
+        pid = os.fork()
+        if pid == 0:
+            run_worker(self.listen_socket, self.config)
+        self.workers.add(pid)
+        return pid
+
+    def reload(self):
+        try:
+            config = Config(self.config.filename)
+        except (ConfigError, IOError, ValueError, IndexError) as e:
+            self.log("reload failed, keeping the old configuration: %s" % e)
+            return
+
+        self.config = config
+        old_workers = self.workers
+        self.workers = set()
+        self.spawn_worker()
+        for pid in old_workers:
+            os.kill(pid, signal.SIGQUIT)
+        self.log("reconfiguring, started a new worker")
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                return
+            if not pid:
+                return
+            self.workers.discard(pid)
+
+    def stop(self):
+        for pid in self.workers:
+            os.kill(pid, signal.SIGTERM)
+        try:
+            os.unlink(self.config.pid_file)
+        except OSError:
+            pass
+
+    def run(self):
+        with file(self.config.pid_file, 'w') as pid_file:
+            pid_file.write("%s\n" % os.getpid())
+
+        for signum in (signal.SIGHUP, signal.SIGCHLD, signal.SIGTERM, signal.SIGINT, signal.SIGQUIT):
+            signal.signal(signum, lambda signum, frame: self.signals.append(signum))
+
+        self.spawn_worker()
+        while True:
+            while self.signals:
+                signum = self.signals.pop(0)
+                if signum == signal.SIGHUP:
+                    self.reload()
+                elif signum == signal.SIGCHLD:
+                    self.reap()
+                else:
+                    self.stop()
+                    return
+            time.sleep(0.01)
+
+def main(argv):
+    test = "-t" in argv
+    if "-c" not in argv:
+        print >>sys.stderr, "usage: proxy.py [-t] -c nginx.conf"
+        sys.exit(1)
+    filename = os.path.abspath(argv[argv.index("-c") + 1])
+
+    try:
+        config = Config(filename)
+    except (ConfigError, IOError, ValueError, IndexError) as e:
+        print >>sys.stderr, "proxy: [emerg] %s in %s" % (e, filename)
+        sys.exit(1)
+
+    if test:
+        print >>sys.stderr, "proxy: the configuration file %s syntax is ok" % filename
+        print >>sys.stderr, "proxy: configuration file %s test is successful" % filename
+        return
+
+    master = Master(config)
+
+    # Daemonize once the socket is bound, so startup errors are reported.
+    if os.fork():
+        os._exit(0)
+    os.setsid()
+    null = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(null, fd)
+
+    master.run()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
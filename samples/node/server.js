@@ -67,7 +67,8 @@ server.addListener("listening", function () {
     var pid = process.pid;
     var port = server.address().port;
 
-    var pid_filename = "node.pid";
+    // zdd tells each replica where to write its pid file
+    var pid_filename = process.env.ZDD_PID_FILE || "node.pid";
     var port_filename = pid.toString() + ".port";
 
     console.log("port", server.address().port, "pid", process.pid);
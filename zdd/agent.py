@@ -0,0 +1,350 @@
+"""A long running zdd which takes commands over a Unix socket.
+
+The agent runs one command at a time, in the order they arrive. A deploy
+which arrives while another deploy is still queued is merged into it, so a
+burst of deploys, of the same or different services, becomes one cutover.
+What is running and what is queued, and the pids and ports of each service
+as of the last command, are kept in memory to answer status requests
+without reading pid files or signaling anything.
+
+Requests and responses are one JSON object per line::
+
+  {"command": "deploy", "services": ["web"]}
+  {"command": "rollback"}
+  {"command": "status"}
+
+services is optional, without it every service is deployed. Each response
+has "ok", and "error" when it is false.
+"""
+from __future__ import with_statement
+
+from optparse import OptionParser
+import errno
+import json
+import os
+import select
+import signal
+import socket
+import sys
+import threading
+
+from zdd.deploy import deploy, rollback, load_config, running_instances, deploy_option_parser, parse_deploy_options
+from zdd.report import Timeline, append_history
+from zdd.supervise import get_supervisor
+
+DEFAULT_SOCKET = "zdd.sock"
+# Seconds ctl waits for a response, long enough for a deploy to finish.
+DEFAULT_TIMEOUT = 600.0
+COMMANDS = ("deploy", "rollback", "status")
+# How often the main thread wakes up, Python signal handlers only run there.
+ACCEPT_INTERVAL = 0.05
+
+class AgentError(Exception):
+    pass
+
+class Job(object):
+    """A deploy or rollback, and the requests waiting for it."""
+
+    def __init__(self, command, names=None):
+        self.command = command
+        # A set of service names, or None for every service
+        self.names = names
+        self.requests = 1
+        self.done = threading.Event()
+        self.ok = None
+        self.error = None
+        self.timeline = None
+
+    def merge(self, names):
+        """Deploy names as well, for one more request."""
+        if self.names is None or names is None:
+            self.names = None
+        else:
+            self.names |= names
+        self.requests += 1
+
+    def describe(self):
+        return {
+            "command": self.command,
+            "services": sorted(self.names) if self.names is not None else None,
+            "requests": self.requests,
+        }
+
+    def result(self):
+        result = self.describe()
+        result["ok"] = self.ok
+        if self.error:
+            result["error"] = self.error
+        if self.timeline:
+            result["timeline"] = self.timeline.to_dict()
+        return result
+
+class Agent(object):
+    def __init__(self, config_file, drain="background", report=None, history=None):
+        self.config_file = config_file
+        self.drain = drain
+        self.report = report
+        self.history = history
+        self.condition = threading.Condition()
+        self.queue = []
+        self.running = None
+        # Service name to {"pids", "ports", "last"}
+        self.services = {}
+        self.refresh()
+
+    def refresh(self):
+        """Read the pids and ports of every service from disk. Only called
+        between jobs, so status requests never have to."""
+        config, services, nginx = load_config(self.config_file)
+        found = {}
+        for service in services:
+            running = running_instances([service])
+            found[service.name] = {
+                "pids": [rs.pid for rs in running],
+                "ports": [rs.port for rs in running],
+                "last": self.services.get(service.name, {}).get("last"),
+            }
+        with self.condition:
+            self.services = found
+
+    def submit(self, command, names=None):
+        """Queue a deploy or rollback, or merge a deploy into the deploy
+        queued last. Returns the Job to wait on."""
+        with self.condition:
+            last = self.queue[-1] if self.queue else None
+            if command == "deploy" and last and last.command == "deploy":
+                last.merge(names)
+                return last
+
+            job = Job(command, names)
+            self.queue.append(job)
+            self.condition.notify()
+            return job
+
+    def status(self):
+        with self.condition:
+            services = {}
+            for name, state in self.services.items():
+                services[name] = dict(state)
+                if self.running and (self.running.names is None or name in self.running.names):
+                    services[name]["state"] = self.running.command
+                elif any(job.names is None or name in job.names for job in self.queue):
+                    services[name]["state"] = "queued"
+                else:
+                    services[name]["state"] = "idle"
+            return {
+                "ok": True,
+                "services": services,
+                "running": self.running.describe() if self.running else None,
+                "queue": [job.describe() for job in self.queue],
+            }
+
+    def run_job(self, job):
+        job.timeline = Timeline()
+        try:
+            if job.command == "deploy":
+                names = sorted(job.names) if job.names is not None else None
+                deploy(self.config_file, job.timeline, self.drain, names)
+            else:
+                rollback(self.config_file, job.timeline, self.drain)
+        except SystemExit:
+            job.ok = False
+            job.error = "%s failed, see the agent's output." % job.command
+        except Exception as e:
+            job.ok = False
+            job.error = "%s failed: %s" % (job.command, e)
+        else:
+            job.ok = True
+        job.timeline.finish(job.ok)
+
+        if self.report == "json":
+            print job.timeline.to_json()
+        if self.history:
+            append_history(self.history, job.timeline)
+        sys.stdout.flush()
+
+    def work(self):
+        """Run queued jobs one at a time, forever."""
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                job = self.running = self.queue.pop(0)
+
+            print "Running %s for %d requests." % (job.command, job.requests)
+            self.run_job(job)
+            try:
+                self.refresh()
+            except Exception as e:
+                print >>sys.stderr, "ERROR: Unable to read the state of the services. %s" % e
+
+            with self.condition:
+                for name, state in self.services.items():
+                    if job.names is None or name in job.names:
+                        state["last"] = {"command": job.command, "ok": job.ok, "finished": job.timeline.finished,
+                                         "duration": job.timeline.finished - job.timeline.started}
+                self.running = None
+            job.done.set()
+
+    def handle(self, request):
+        """The response to one request."""
+        command = request.get("command")
+        if command == "status":
+            return self.status()
+        if command not in COMMANDS:
+            return {"ok": False, "error": "Unknown command %r, expected one of %s." % (command, ", ".join(COMMANDS))}
+
+        names = request.get("services") if command == "deploy" else None
+        if names is not None:
+            names = set(names)
+            unknown = names - set(self.services)
+            if unknown:
+                return {"ok": False, "error": "No such service: %s" % " ".join(sorted(unknown))}
+
+        job = self.submit(command, names)
+        # Event.wait() without a timeout can't be interrupted in Python 2.
+        while not job.done.is_set():
+            job.done.wait(1.0)
+        return job.result()
+
+    def serve_connection(self, connection):
+        try:
+            line = connection.makefile('r').readline()
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("expected a JSON object")
+            except ValueError as e:
+                response = {"ok": False, "error": "Invalid request: %s" % e}
+            else:
+                response = self.handle(request)
+            connection.sendall(json.dumps(response, sort_keys=True) + "\n")
+        except socket.error:
+            pass
+        finally:
+            connection.close()
+
+def listen(socket_path):
+    """A listening Unix socket at socket_path, replacing a stale one left
+    by an agent which didn't exit cleanly."""
+    if os.path.exists(socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+        except socket.error:
+            os.unlink(socket_path)
+        else:
+            raise AgentError("An agent is already listening on %s." % socket_path)
+        finally:
+            probe.close()
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(16)
+    return server
+
+def serve(agent, socket_path):
+    # The supervisor's SIGCHLD handler must be installed from the main thread.
+    get_supervisor()
+
+    server = listen(socket_path)
+    worker = threading.Thread(target=agent.work)
+    worker.daemon = True
+    worker.start()
+    print "zdd agent listening on %s." % socket_path
+    sys.stdout.flush()
+
+    try:
+        while True:
+            try:
+                readable = select.select([server], [], [], ACCEPT_INTERVAL)[0]
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not readable:
+                continue
+            connection, address = server.accept()
+            thread = threading.Thread(target=agent.serve_connection, args=(connection,))
+            thread.daemon = True
+            thread.start()
+    finally:
+        server.close()
+        os.unlink(socket_path)
+
+def send(socket_path, request, timeout=DEFAULT_TIMEOUT):
+    """Send request to the agent at socket_path and return its response.
+    Raises socket.timeout if there is none within timeout seconds."""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(socket_path)
+        client.sendall(json.dumps(request) + "\n")
+        return json.loads(client.makefile('r').readline())
+    finally:
+        client.close()
+
+def cli_agent(argv):
+    parser = deploy_option_parser("%prog agent [options]")
+    parser.add_option(
+        "--socket",
+        dest="socket",
+        help="PATH of the Unix socket to listen on. [default %default]",
+        default=DEFAULT_SOCKET,
+        metavar="PATH",
+    )
+    options, args = parse_deploy_options(parser, argv)
+
+    def terminate(signum, frame):
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, terminate)
+
+    agent = Agent(options.deploy_conf, options.drain, options.report, options.history)
+    try:
+        serve(agent, options.socket)
+    except AgentError as e:
+        print >>sys.stderr, "ERROR:", e
+        sys.exit(1)
+    except KeyboardInterrupt:
+        pass
+
+def cli_ctl(argv):
+    parser = OptionParser(usage="%prog ctl [options] deploy [service ...] | rollback | status")
+    parser.add_option(
+        "--socket",
+        dest="socket",
+        help="PATH of the agent's Unix socket. [default %default]",
+        default=DEFAULT_SOCKET,
+        metavar="PATH",
+    )
+    parser.add_option(
+        "--timeout",
+        dest="timeout",
+        type="float",
+        help="Give up after waiting SECONDS for the agent's response. [default %default]",
+        default=DEFAULT_TIMEOUT,
+        metavar="SECONDS",
+    )
+    options, args = parser.parse_args(argv)
+    args = args[1:]
+
+    if not args or args[0] not in COMMANDS:
+        parser.print_help()
+        parser.exit(1)
+
+    request = {"command": args[0]}
+    if args[0] == "deploy" and args[1:]:
+        request["services"] = args[1:]
+
+    try:
+        response = send(options.socket, request, options.timeout)
+    except socket.timeout:
+        print >>sys.stderr, "ERROR: No response from the zdd agent at %s within %ss." % (options.socket, options.timeout)
+        sys.exit(1)
+    except socket.error as e:
+        print >>sys.stderr, "ERROR: Unable to reach the zdd agent at %s: %s" % (options.socket, e)
+        sys.exit(1)
+
+    print json.dumps(response, sort_keys=True, indent=2)
+    if not response.get("ok"):
+        sys.exit(1)
@@ -0,0 +1,182 @@
+"""Gradually shift traffic from the previous instances to the new ones.
+
+Each step of the schedule renders the nginx upstreams with both
+generations, weighted so the new one gets the given percentage of requests,
+and reloads nginx. Before moving on to the next step we read what nginx
+logged since the last step and compare how the two generations did.
+
+This needs nginx to log which upstream served each request. The access
+log lines must end with::
+
+  log_format zdd '... $upstream_addr $upstream_status $upstream_response_time';
+"""
+from __future__ import with_statement
+
+import os
+import time
+
+from zdd.stats import percentile
+
+CANARY_SECTION = "canary"
+DEFAULT_SCHEDULE = "5 25 50 100"
+DEFAULT_INTERVAL = 10.0
+DEFAULT_MAX_ERROR_RATE = 0.01
+DEFAULT_MAX_LATENCY_RATIO = 1.5
+DEFAULT_MIN_REQUESTS = 20
+LATENCY_PERCENTILE = 95.0
+# nginx logs response times in milliseconds, so tiny absolute differences
+# between fast generations can look like huge ratios.
+LATENCY_SLACK = 0.005
+
+def gcd(a, b):
+    while b:
+        a, b = b, a % b
+    return a
+
+def weights(percent, old_count, new_count):
+    """nginx weights (old, new) so that new_count servers of weight new get
+    percent of the requests and old_count servers of weight old get the rest.
+    A weight of 0 means the generation should be left out of the upstream."""
+    if percent >= 100:
+        return 0, 1
+    if percent <= 0:
+        return 1, 0
+
+    old_weight = (100 - percent) * new_count
+    new_weight = percent * old_count
+    divisor = gcd(old_weight, new_weight)
+    return old_weight / divisor, new_weight / divisor
+
+def parse_log_line(line):
+    """(port, status, response time) from an access log line, or None if
+    the request wasn't passed to a single upstream server."""
+    fields = line.split()
+    if len(fields) < 3:
+        return None
+
+    addr, status, response_time = fields[-3:]
+    if ":" not in addr:
+        return None
+    try:
+        return int(addr.rsplit(":", 1)[1]), int(status), float(response_time)
+    except ValueError:
+        # "-" when there was no upstream, or several comma separated
+        # attempts which we can't attribute to one server.
+        return None
+
+class AccessLogTail(object):
+    """Reads the lines appended to a log file since the last read."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        try:
+            self.offset = os.path.getsize(filename)
+        except OSError:
+            self.offset = 0
+
+    def read_lines(self):
+        try:
+            with file(self.filename, 'r') as log_file:
+                if os.fstat(log_file.fileno()).st_size < self.offset:
+                    # Rotated or truncated
+                    self.offset = 0
+                log_file.seek(self.offset)
+                data = log_file.read()
+        except (IOError, OSError):
+            return []
+
+        # Leave a partially written last line for the next read.
+        complete = data.rfind("\n") + 1
+        self.offset += complete
+        return data[:complete].splitlines()
+
+class GenerationStats(object):
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.latencies = []
+
+    def add(self, status, response_time):
+        self.requests += 1
+        if status >= 500:
+            self.errors += 1
+        self.latencies.append(response_time)
+
+    @property
+    def error_rate(self):
+        if not self.requests:
+            return 0.0
+        return float(self.errors) / self.requests
+
+    @property
+    def latency(self):
+        return percentile(self.latencies, LATENCY_PERCENTILE)
+
+    def __str__(self):
+        if not self.requests:
+            return "no requests"
+        return "%d requests, %.1f%% errors, p%g %.1fms" % (
+            self.requests, self.error_rate * 100, LATENCY_PERCENTILE, self.latency * 1000)
+
+def generation_stats(lines, old_ports, new_ports):
+    old, new = GenerationStats(), GenerationStats()
+    for line in lines:
+        parsed = parse_log_line(line)
+        if not parsed:
+            continue
+        port, status, response_time = parsed
+        if port in new_ports:
+            new.add(status, response_time)
+        elif port in old_ports:
+            old.add(status, response_time)
+    return old, new
+
+class Canary(object):
+    def __init__(self, access_log, schedule, interval=DEFAULT_INTERVAL, max_error_rate=DEFAULT_MAX_ERROR_RATE,
+                 max_latency_ratio=DEFAULT_MAX_LATENCY_RATIO, min_requests=DEFAULT_MIN_REQUESTS):
+        self.access_log = access_log
+        self.schedule = schedule
+        self.interval = interval
+        self.max_error_rate = max_error_rate
+        self.max_latency_ratio = max_latency_ratio
+        self.min_requests = min_requests
+
+    @classmethod
+    def from_config(cls, config):
+        """Build a Canary from the [canary] section, or None if there isn't one."""
+        if not config.has_section(CANARY_SECTION):
+            return None
+
+        schedule = [int(step) for step in config.get_default(CANARY_SECTION, "schedule", DEFAULT_SCHEDULE).split()]
+        assert schedule == sorted(schedule) and schedule[-1] == 100, "canary schedule must increase up to 100"
+
+        return cls(
+            config.get_path(CANARY_SECTION, "access_log"),
+            schedule,
+            interval=config.getfloat_default(CANARY_SECTION, "interval", DEFAULT_INTERVAL),
+            max_error_rate=config.getfloat_default(CANARY_SECTION, "max_error_rate", DEFAULT_MAX_ERROR_RATE),
+            max_latency_ratio=config.getfloat_default(CANARY_SECTION, "max_latency_ratio", DEFAULT_MAX_LATENCY_RATIO),
+            min_requests=int(config.get_default(CANARY_SECTION, "min_requests", DEFAULT_MIN_REQUESTS)),
+        )
+
+    def tail(self):
+        return AccessLogTail(self.access_log)
+
+    def observe(self, tail, old_ports, new_ports):
+        """Wait for one step's interval, then return (old, new) GenerationStats
+        for the requests logged in the meantime."""
+        time.sleep(self.interval)
+        return generation_stats(tail.read_lines(), old_ports, new_ports)
+
+    def regression(self, old, new):
+        """Why the new generation is worse than the old one, or None if it isn't."""
+        if new.requests < self.min_requests:
+            # Not enough traffic to judge, don't block the deploy on it.
+            return None
+
+        if new.error_rate > old.error_rate + self.max_error_rate:
+            return "error rate %.1f%% vs %.1f%%" % (new.error_rate * 100, old.error_rate * 100)
+
+        if (old.requests >= self.min_requests and new.latency > old.latency * self.max_latency_ratio
+                and new.latency - old.latency > LATENCY_SLACK):
+            return "p%g latency %.1fms vs %.1fms" % (LATENCY_PERCENTILE, new.latency * 1000, old.latency * 1000)
@@ -6,10 +6,27 @@ import os
 import signal
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 
+from zdd.canary import Canary, weights
+from zdd.drain import Drain, pid_alive, drain_all, drain_in_background, run_detached, DEFAULT_DRAIN_TIMEOUT, DEFAULT_KILL_TIMEOUT
+from zdd.proc import proc_available, child_pids, is_alive, allowed_cpus, set_cpu_affinity, tree_rss
+from zdd.readiness import wait_for_all, ReadinessTimeout, ReadinessFailed
+from zdd.schedule import MemoryBudget, next_batch, format_size
+from zdd.report import Timeline, append_history, read_history, format_stats
+from zdd.supervise import get_supervisor, CommandFailed
+from zdd.template import CompiledTemplate, load_template, write_atomic
+from zdd.warmup import Warmup, WarmupError
+
 SERVICE_PREFIX = "service:"
 NGINX_TEMPLATE_SUFFIX = ".template"
+DEFAULT_READY_TIMEOUT = 30.0
+DEFAULT_RELOAD_TIMEOUT = 30.0
+# Made up ports for checking the nginx template before the real ones are known
+PLACEHOLDER_PORT = 10000
+RELOAD_POLL_INTERVAL = 0.01
 
 class _Settings(object):
     VERBOSE = False
@@ -36,6 +53,36 @@ def write_int_file(filename, number):
     with file(filename, 'w') as pidfile:
         pidfile.write(str(number))
 
+def read_int_list_file(filename):
+    """Read a file of whitespace separated integers, such as a pid per line."""
+    try:
+        with file(filename, 'r') as pidfile:
+            return [int(number) for number in pidfile.read().split()]
+    except (IOError, OSError, ValueError):
+        return []
+
+def write_int_list_file(filename, numbers):
+    with file(filename, 'w') as pidfile:
+        pidfile.write("".join("%s\n" % number for number in numbers))
+
+def read_retained_file(filename):
+    """Read a retained pid file, mapping each pid to the deadline its
+    retirer was given, as written. None for files without deadlines."""
+    retained = {}
+    try:
+        with file(filename, 'r') as pidfile:
+            for line in pidfile:
+                fields = line.split()
+                if fields:
+                    retained[int(fields[0])] = fields[1] if len(fields) > 1 else None
+    except (IOError, OSError, ValueError):
+        return {}
+    return retained
+
+def write_retained_file(filename, retained):
+    with file(filename, 'w') as pidfile:
+        pidfile.write("".join("%s %s\n" % (pid, deadline) for pid, deadline in sorted(retained.items())))
+
 def read_pid(filename):
     pid = read_int_file(filename)
     if pid and check_pid(pid):
@@ -66,35 +113,93 @@ class Service(object):
             self.cwd = config.get_path(section, "cwd")
         except ConfigParserError:
             self.cwd = config.config_dir
+        self.ready_timeout = config.getfloat_default(section, "ready_timeout", DEFAULT_READY_TIMEOUT)
+        self.output_file = config.get_path(section, "output_file") if config.has_option(section, "output_file") \
+            else os.path.splitext(self.pid_file)[0] + ".out"
+        self.warmup = Warmup.from_config(config, section)
+        self.drain_timeout = config.getfloat_default(section, "drain_timeout", DEFAULT_DRAIN_TIMEOUT)
+        self.kill_timeout = config.getfloat_default(section, "kill_timeout", DEFAULT_KILL_TIMEOUT)
+        # Seconds to keep the previous instances alive after a deploy, for rollback
+        self.retain_previous = config.getfloat_default(section, "retain_previous", 0.0)
+
+        replicas = config.get_default(section, "replicas", "1")
+        if replicas == "auto":
+            self.replica_count = len(allowed_cpus())
+        else:
+            self.replica_count = int(replicas)
+        assert self.replica_count >= 1, "replicas must be at least 1"
+        self.cpu_affinity = config.getboolean_default(section, "cpu_affinity", False)
+        self.replicas = [Replica(self, index) for index in xrange(self.replica_count)]
 
-        self.previous_pid = None
-        self.current_pid = None
+        self.previous_pids = []
+        self.current_pids = []
 
     def run_cmd(self, command, *args, **kwargs):
+        """Run command to completion, raises CommandFailed if it fails."""
         kwargs['cwd'] = self.cwd
         if settings.VERBOSE:
             print "Running:", " ".join(command), "in directory", self.cwd
-        return subprocess.Popen(command, *args, **kwargs)
+        return get_supervisor().run(command, *args, **kwargs)
 
-    def start(self):
-        self.run_cmd(self.start_cmd.split(' '))
+    def spawn_cmd(self, name, command, *args, **kwargs):
+        """Start command and return its supervised Child, with its output going to output_file."""
+        kwargs['cwd'] = self.cwd
+        if settings.VERBOSE:
+            print "Running:", " ".join(command), "in directory", self.cwd
+        return get_supervisor().spawn(name, command, self.output_file, *args, **kwargs)
+
+    def start(self, replica):
+        """Start one replica. {pid_file} and {replica} in the start command are
+        replaced, and also passed as ZDD_PID_FILE and ZDD_REPLICA in the environment."""
+        replacements = {'pid_file': replica.pid_file, 'replica': str(replica.index)}
+        command = [template_replace(arg, replacements) for arg in self.start_cmd.split(' ')]
+
+        env = dict(os.environ, ZDD_PID_FILE=replica.pid_file, ZDD_REPLICA=str(replica.index))
+
+        preexec_fn = None
+        if self.cpu_affinity:
+            cpus = allowed_cpus()
+            cpu = cpus[replica.index % len(cpus)]
+            preexec_fn = lambda: set_cpu_affinity([cpu])
+
+        replica.child = self.spawn_cmd(replica.name, command, env=env, preexec_fn=preexec_fn)
 
     def stop(self, pid):
+        """Run the stop command for pid, raises CommandFailed if it fails."""
         self.run_cmd(self.stop_cmd.split(' ') + [str(pid)])
 
-    def read_pid(self):
-        return read_pid(self.pid_file)
+    def read_pids(self):
+        """Live pids written by the replicas of this service."""
+        return [pid for pid in (replica.read_pid() for replica in self.replicas) if pid]
 
-    def read_port(self):
-        pid = self.read_pid()
-        if not pid:
-            return
+    def instance_pids(self, exclude=()):
+        """Live pids of the current instances, from the current pid file and
+        the replicas' pid files, leaving out exclude. Staged instances also
+        write the replicas' pid files, but aren't current until promoted."""
+        exclude = set(exclude) | set(read_int_list_file(self.staged_pid_filename))
+        pids = [pid for pid in self.read_pids() if pid not in exclude]
+        for pid in read_int_list_file(self.current_pid_filename):
+            if pid not in pids and pid not in exclude and check_pid(pid):
+                pids.append(pid)
+        return pids
 
-        port = read_port(os.path.dirname(self.pid_file), pid)
-        if not port:
-            return
+    def memory_usage(self, exclude=(), previous=False):
+        """Bytes of memory used by the current instances and their children,
+        and by any previous instances still running if previous is true."""
+        pids = self.instance_pids(exclude)
+        if previous:
+            pids.extend(pid for pid in read_int_list_file(self.previous_pid_filename)
+                        if pid not in pids and pid not in exclude and check_pid(pid))
+        return sum(tree_rss(pid) for pid in pids)
 
-        return RunningService(self, pid, port)
+    def read_running(self, pids):
+        """RunningServices for those of pids which are still alive and have a port file."""
+        running = []
+        for pid in pids:
+            port = read_port(os.path.dirname(self.pid_file), pid)
+            if port and check_pid(pid):
+                running.append(RunningService(self, pid, port))
+        return running
 
     def _named_pid_file(self, name):
         """Generates foo.name.pid paths, for example gunicorn.current.pid."""
@@ -110,17 +215,206 @@ class Service(object):
     def previous_pid_filename(self):
         return self._named_pid_file("previous")
 
+    @property
+    def staged_pid_filename(self):
+        return self._named_pid_file("staged")
+
+    @property
+    def retained_pid_filename(self):
+        """The previous instances kept for rollback, which were never sent the stop command."""
+        return self._named_pid_file("retained")
+
+
+class Replica(object):
+    """One of the processes of a service. Each replica writes its own pid file."""
+
+    def __init__(self, service, index):
+        self.service = service
+        self.index = index
+        # The supervised Child of the last start command
+        self.child = None
+
+    @property
+    def name(self):
+        if self.service.replica_count == 1:
+            return self.service.name
+        return "%s[%d]" % (self.service.name, self.index)
+
+    @property
+    def pid_file(self):
+        """The service's pid_file, or foo.N.pid for each of several replicas."""
+        if self.service.replica_count == 1:
+            return self.service.pid_file
+        return self.service._named_pid_file(str(self.index))
+
+    @property
+    def ready_timeout(self):
+        return self.service.ready_timeout
+
+    @property
+    def watch_directory(self):
+        """Where the pid and port files appear."""
+        return os.path.dirname(self.pid_file)
+
+    def read_pid(self):
+        return read_pid(self.pid_file)
+
+    def read_port(self):
+        pid = self.read_pid()
+        if not pid:
+            return
+
+        port = read_port(os.path.dirname(self.pid_file), pid)
+        if not port:
+            return
+
+        return RunningService(self.service, pid, port, self)
+
+    def failure(self):
+        """Why this replica will never become ready, if its start command
+        crashed, or the process in its pid file has already exited. The
+        latter catches servers which daemonize and then die."""
+        if self.child and self.child.crashed:
+            return self.child.describe()
+
+        # The pid file was moved aside before we started, so any pid in it is new.
+        pid = read_int_file(self.pid_file)
+        if pid and not pid_alive(pid):
+            lines = ["%s process %s exited before it was ready." % (self.name, pid)]
+            tail = self.child.output_tail() if self.child else []
+            if tail:
+                lines.append("Last output in %s:" % self.child.output_filename)
+                lines.extend("    " + line for line in tail)
+            return "\n".join(lines)
 
 class RunningService(object):
-    def __init__(self, service, pid, port):
+    def __init__(self, service, pid, port, replica=None):
         self.service = service
         self.pid = pid
         self.port = port
+        self.replica = replica
+
+    @property
+    def name(self):
+        if self.replica:
+            return self.replica.name
+        return self.service.name
+
+def upstream_servers(ports, weight=1):
+    """nginx upstream server lines for ports, all on one line."""
+    if weight == 1:
+        return " ".join("server 127.0.0.1:%s;" % port for port in ports)
+    return " ".join("server 127.0.0.1:%s weight=%d;" % (port, weight) for port in ports)
+
+def placeholder_replacements(services, others=()):
+    """Template replacements with made up ports, for checking the template
+    while the new instances are still starting. others are the
+    RunningServices of services which are not being deployed."""
+    running = list(others)
+    port = PLACEHOLDER_PORT
+    for service in services:
+        for replica in service.replicas:
+            running.append(RunningService(service, None, port, replica))
+            port += 1
+    return service_replacements(running)
+
+def service_replacements(running, previous=(), percent=100):
+    """Template replacements for a list of RunningServices.
+
+    {name} is the port of the first replica, for a single upstream server line,
+    and {name:servers} is a server line for every replica of the service.
+
+    With a percent below 100, {name:servers} also lists the previous
+    RunningServices, weighted so the new ones get percent of the requests.
+    """
+    ports = {}
+    for rs in running:
+        ports.setdefault(rs.service.name, []).append(rs.port)
+    previous_ports = {}
+    for rs in previous:
+        previous_ports.setdefault(rs.service.name, []).append(rs.port)
+
+    replacements = {}
+    for name, service_ports in ports.items():
+        old_ports = previous_ports.get(name, [])
+        if old_ports and percent < 100:
+            old_weight, new_weight = weights(percent, len(old_ports), len(service_ports))
+            servers = []
+            if old_weight:
+                servers.append(upstream_servers(old_ports, old_weight))
+                replacements[name] = str(old_ports[0])
+            if new_weight:
+                servers.append(upstream_servers(service_ports, new_weight))
+                replacements[name] = str(service_ports[0])
+            replacements[name + ":servers"] = " ".join(servers)
+        else:
+            replacements[name] = str(service_ports[0])
+            replacements[name + ":servers"] = upstream_servers(service_ports)
+    return replacements
+
+class NginxReloadError(Exception):
+    pass
+
+class NginxConfigError(Exception):
+    pass
+
+class ConfigCheck(object):
+    """Runs nginx -t against a candidate config in the background."""
+
+    def __init__(self, nginx, content):
+        dirname, basename = os.path.split(nginx.rendered_config_filename)
+        # Same directory as nginx.conf, so relative includes resolve the same way.
+        fd, self.filename = tempfile.mkstemp(prefix="." + basename + ".check.", dir=dirname)
+        with os.fdopen(fd, 'w') as candidate:
+            candidate.write(content)
+
+        command = nginx.command.split(' ') + ["-t", "-c", self.filename]
+        if settings.VERBOSE:
+            print "Running:", " ".join(command)
+        try:
+            self.process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        except OSError as e:
+            # Reported by wait(), once the caller is ready to deal with it.
+            self.process = None
+            self.error = NginxConfigError("Unable to run %s to check the nginx config: %s. "
+                                          "Set command or validate: false in the [nginx] section." % (command[0], e))
+
+    def wait(self):
+        """Raises NginxConfigError with nginx's output if the config is invalid."""
+        try:
+            if not self.process:
+                raise self.error
+            output = self.process.communicate()[0]
+        finally:
+            os.unlink(self.filename)
+
+        if self.process.returncode != 0:
+            raise NginxConfigError(output.strip().replace(self.filename, "nginx.conf"))
+
+    def cancel(self):
+        """Kill the check if it is still running and remove the candidate,
+        for when the deploy is aborted without waiting for it."""
+        if self.process and self.process.poll() is None:
+            try:
+                self.process.kill()
+            except OSError:
+                pass
+            self.process.wait()
+            self.process.stdout.close()
+        try:
+            os.unlink(self.filename)
+        except OSError:
+            pass
 
 class Nginx(object):
     def __init__(self, config):
         self.template = config.get_path("nginx", "template")
         self.pid_file = config.get_path("nginx", "pid_file")
+        self.command = config.get_default("nginx", "command", "nginx")
+        self.reload_timeout = config.getfloat_default("nginx", "reload_timeout", DEFAULT_RELOAD_TIMEOUT)
+        self.validate = config.getboolean_default("nginx", "validate", True)
+        # Until we render it ourselves, assume nginx.conf differs from what nginx runs.
+        self.config_changed = True
 
         assert self.template.endswith(NGINX_TEMPLATE_SUFFIX), "nginx template name must end with " + NGINX_TEMPLATE_SUFFIX
 
@@ -132,35 +426,93 @@ class Nginx(object):
     def read_pid(self):
         return read_pid(self.pid_file)
 
-    def render_config(self, replacements):
-        """Render nginx.conf template into nginx.conf"""
-
+    def render(self, replacements):
         replacements['nginx_pid_filename'] = self.pid_file
+        return load_template(self.template).render(replacements)
 
-        with file(self.template, 'r') as template_file:
-            template_content = template_file.read()
+    def render_config(self, replacements):
+        """Render nginx.conf template into nginx.conf. Returns False if
+        nginx.conf already had the same content."""
+        nginx_conf_content = self.render(replacements)
 
-        nginx_conf_content = template_replace(template_content, replacements)
+        self.config_changed = write_atomic(self.rendered_config_filename, nginx_conf_content)
+        return self.config_changed
 
-        with file(self.rendered_config_filename, 'w') as nginx_conf:
-            nginx_conf.write(nginx_conf_content)
+    def check_config(self, replacements):
+        """Start checking the config rendered with replacements. Returns a
+        ConfigCheck to wait() on, or None if validation is turned off."""
+        if not self.validate:
+            return None
+        return ConfigCheck(self, self.render(replacements))
 
-    def reconfig(self):
-        """SIGHUP or spawn a new nginx."""
+    def reconfig(self, timeline=None):
+        """SIGHUP or spawn a new nginx, and wait until it serves the new config."""
+        timeline = timeline or Timeline()
         nginx_pid = self.read_pid()
-        if nginx_pid:
-            print "Sending SIGHUP to existing nginx process %s." % nginx_pid
-            os.kill(nginx_pid, signal.SIGHUP)
+        if nginx_pid and not self.config_changed:
+            print "nginx configuration unchanged, not reloading nginx process %s." % nginx_pid
+        elif nginx_pid:
+            with timeline.phase("reload"):
+                old_workers = child_pids(nginx_pid) if proc_available() else set()
+                print "Sending SIGHUP to existing nginx process %s." % nginx_pid
+                os.kill(nginx_pid, signal.SIGHUP)
+            with timeline.phase("reload_confirm"):
+                self.wait_for_reload(nginx_pid, old_workers)
         else:
-            print "Spawning new nginx."
-            subprocess.Popen(["nginx", "-c", self.rendered_config_filename])
+            with timeline.phase("reload"):
+                print "Spawning new nginx."
+                command = self.command.split(' ') + ["-c", self.rendered_config_filename]
+                child = get_supervisor().spawn("nginx", command, os.path.splitext(self.pid_file)[0] + ".out")
+            with timeline.phase("reload_confirm"):
+                self.wait_for_reload(None, set(), child)
+
+    def wait_for_reload(self, nginx_pid, old_workers, child=None):
+        """Wait until the nginx master has new workers and every old worker has exited.
+
+        On SIGHUP the master starts a new generation of workers with the new
+        config, then asks the old ones to finish their requests and exit. If
+        the new config is invalid the master logs an error and keeps the old
+        workers, so we never see a new generation and time out.
+
+        child is the supervised nginx process, when we just spawned it.
+        """
+        if not proc_available():
+            # Without /proc there is no way to tell, so guess.
+            if settings.VERBOSE:
+                print "No /proc, waiting 1s for nginx to reload."
+            time.sleep(1)
+            return
+
+        deadline = time.time() + self.reload_timeout
+        new_workers = old_remaining = set()
+        while time.time() < deadline:
+            if nginx_pid is None:
+                # Freshly spawned, wait for it to daemonize and write its pid file.
+                if child and child.crashed:
+                    raise NginxReloadError("Unable to start nginx. %s" % child.describe())
+                nginx_pid = self.read_pid()
+            elif not is_alive(nginx_pid):
+                raise NginxReloadError("nginx process %s exited while reloading." % nginx_pid)
+
+            if nginx_pid is not None:
+                workers = child_pids(nginx_pid)
+                new_workers = workers - old_workers
+                old_remaining = workers & old_workers
+                if new_workers and not old_remaining:
+                    if settings.VERBOSE:
+                        print "nginx reloaded, new workers %s." % " ".join(str(pid) for pid in sorted(new_workers))
+                    return
+
+            time.sleep(RELOAD_POLL_INTERVAL)
+
+        raise NginxReloadError(
+            "nginx did not finish reloading within %ss (%d new workers, %d old workers still running). "
+            "Check the nginx error log." % (self.reload_timeout, len(new_workers), len(old_remaining))
+        )
 
 def template_replace(template, replacements):
-    # Feel free to swap in your own real templating engine
-    # str.replace used only to remove a dependency
-    for key, value in sorted(replacements.items()):
-        template = template.replace("{%s}" % key, value)
-    return template
+    # Feel free to swap in your own real templating engine, see zdd.template
+    return CompiledTemplate(template).render(replacements)
 
 class DeployConfigParser(SafeConfigParser):
     def read(self, filename):
@@ -171,66 +523,509 @@ class DeployConfigParser(SafeConfigParser):
         relpath = self.get(*args, **kwargs)
         return os.path.abspath(os.path.join(self.config_dir, relpath))
 
-def move_old_pidfiles(services):
+    def get_default(self, section, option, default=None):
+        if not self.has_option(section, option):
+            return default
+        return self.get(section, option)
+
+    def getfloat_default(self, section, option, default=None):
+        if not self.has_option(section, option):
+            return default
+        return self.getfloat(section, option)
+
+    def getboolean_default(self, section, option, default=None):
+        if not self.has_option(section, option):
+            return default
+        return self.getboolean(section, option)
+
+def discard_staged(services):
+    """Stop instances left staged by zddeploy stage, which never got any
+    requests. Returns their pids, which must not be taken for the current ones."""
+    staged = set()
+    for service in services:
+        for pid in read_int_list_file(service.staged_pid_filename):
+            staged.add(pid)
+            if not check_pid(pid):
+                continue
+            print "Stopping staged instance of %s, process %s." % (service.name, pid)
+            try:
+                service.stop(pid)
+            except CommandFailed as e:
+                print >>sys.stderr, "ERROR: Unable to stop staged instance of %s. %s" % (service.name, e.describe())
+        try:
+            os.unlink(service.staged_pid_filename)
+        except OSError:
+            pass
+    return staged
+
+def collect_old_pids(services, exclude=()):
+    """Find the live instances of the current generation, as previous_pids,
+    and delete their pid files so the new instances' can be waited for."""
+    for service in services:
+        service.previous_pids = service.instance_pids(exclude)
+
+        for replica in service.replicas:
+            try:
+                os.unlink(replica.pid_file)
+            except OSError:
+                pass
+
+def move_old_pidfiles(services, exclude=()):
     """Save old pid files and then delete them"""
+    collect_old_pids(services, exclude)
     for service in services:
-        pid = service.read_pid() or read_pid(service.current_pid_filename)
-        if not pid:
-            continue
+        if service.previous_pids:
+            write_int_list_file(service.previous_pid_filename, service.previous_pids)
+
+def warm_up(running, timeline):
+    """Run the warmups of all running services at the same time.
+    Returns a list of (RunningService, WarmupError) for the ones that failed."""
+    failures = []
+
+    def run(rs):
+        try:
+            with timeline.phase("warmup:%s" % rs.name):
+                warmup_round = rs.service.warmup.run(rs.port)
+        except WarmupError as e:
+            failures.append((rs, e))
+        else:
+            print "%s warmed up, p%g latency %.1fms." % (rs.name, rs.service.warmup.pct, warmup_round.latency(rs.service.warmup.pct) * 1000)
+
+    threads = [threading.Thread(target=run, args=(rs,)) for rs in running if rs.service.warmup]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return failures
+
+def shift_traffic(nginx, canary, running, previous, timeline, others=()):
+    """Move requests from the previous to the new instances step by step,
+    following the canary schedule. Returns True once the new instances get
+    all requests, or False if they did worse than the previous instances, in
+    which case nginx has been pointed back at the previous instances.
+    others are the RunningServices of services which are not being deployed."""
+    old_ports = set(rs.port for rs in previous)
+    new_ports = set(rs.port for rs in running)
+    tail = canary.tail()
 
-        service.previous_pid = pid
+    for percent in canary.schedule:
+        print "Sending %d%% of requests to the new instances." % percent
+        with timeline.phase("render"):
+            nginx.render_config(service_replacements(list(running) + list(others), previous, percent))
+        nginx.reconfig(timeline)
+        if percent >= 100:
+            return True
 
-        write_int_file(service.previous_pid_filename, pid)
+        with timeline.phase("canary:%d%%" % percent):
+            old, new = canary.observe(tail, old_ports, new_ports)
+        print "Previous instances: %s. New instances: %s." % (old, new)
+
+        reason = canary.regression(old, new)
+        if reason:
+            print >>sys.stderr, "New instances are worse than the previous ones (%s), rolling back." % reason
+            with timeline.phase("render"):
+                nginx.render_config(service_replacements(list(running) + list(others), previous, 0))
+            nginx.reconfig(timeline)
+            return False
+
+def stop_new_instances(services, running):
+    """Abort a deploy: stop the new instances, and make the previous ones
+    current again. nginx must not be sending requests to running.
+
+    New instances which aren't ready yet are stopped too, if they have
+    written their pid file, or terminated if they are still our child.
+    """
+    pids = [(rs.service, rs.pid) for rs in running]
+    running_pids = set(rs.pid for rs in running)
+    for service in services:
+        for replica in service.replicas:
+            pid = replica.read_pid()
+            if pid and pid not in running_pids and pid not in service.previous_pids:
+                pids.append((service, pid))
+            elif not pid and replica.child and replica.child.poll() is None:
+                print "Terminating new instance of %s, process %s." % (service.name, replica.child.pid)
+                replica.child.process.terminate()
 
+    for service, pid in pids:
+        print "Stopping new instance of %s, process %s." % (service.name, pid)
         try:
-            os.unlink(service.pid_file)
+            service.stop(pid)
+        except CommandFailed as e:
+            print >>sys.stderr, "ERROR: Unable to stop new instance of %s. %s" % (service.name, e.describe())
+
+    for service in services:
+        service.current_pids, service.previous_pids = service.previous_pids, []
+        write_int_list_file(service.current_pid_filename, service.current_pids)
+        try:
+            os.unlink(service.previous_pid_filename)
         except OSError:
             pass
 
-def deploy(config_file):
+DRAIN_MODES = ("wait", "background")
+
+def load_config(config_file):
+    """Returns the parsed config, its services and nginx."""
     config = DeployConfigParser()
     config.read(config_file)
 
     services = [Service(config, section) for section in config.sections() if section.startswith(SERVICE_PREFIX)]
+    return config, services, Nginx(config)
 
-    move_old_pidfiles(services)
-
+def start_new_generation(services, nginx, timeline, others=()):
+    """Start, wait for and warm up new instances of every service, checking
+    the nginx config meanwhile, with others as the RunningServices of the
+    services not being deployed. Returns the new RunningServices. If
+    anything fails, the new instances are stopped and we exit."""
     # Spawn new services
+    replicas = [replica for service in services for replica in service.replicas]
+    for replica in replicas:
+        print "Starting new", replica.name
+        try:
+            with timeline.phase("spawn:%s" % replica.name):
+                replica.service.start(replica)
+        except OSError as e:
+            # A missing start command, or cpu_affinity failing in the child.
+            print >>sys.stderr, "Unable to start %s: %s" % (replica.name, e)
+            stop_new_instances(services, [])
+            sys.exit(1)
+
+    # Check the template while they start, so a broken one costs no extra time.
+    preflight = nginx.check_config(placeholder_replacements(services, others))
+
+    # Wait for new services to spin up, all at once, and save their pids
+    ready_start = time.time()
+
+    def on_ready(replica, rs):
+        timeline.record("ready:%s" % replica.name, ready_start, time.time())
+        print "%s succesfully started, process %s listening on port %s." % (replica.name, rs.pid, rs.port)
+
+    supervisor = get_supervisor()
+    try:
+        with timeline.phase("ready"):
+            running = wait_for_all(replicas, on_ready, [supervisor.fileno()])
+    except ReadinessTimeout as e:
+        for replica in e.targets:
+            print >>sys.stderr, "Unable to start %s, timeout after %ss while waiting for port file." % (replica.name, replica.ready_timeout)
+        if preflight:
+            preflight.cancel()
+        stop_new_instances(services, e.ready)
+        sys.exit(1)
+    except ReadinessFailed as e:
+        print >>sys.stderr, "Unable to start %s, it crashed before it was ready: %s" % (e.targets[0].name, e.reason)
+        if preflight:
+            preflight.cancel()
+        stop_new_instances(services, e.ready)
+        sys.exit(1)
+
+    try:
+        with timeline.phase("preflight"):
+            if preflight:
+                preflight.wait()
+
+        # The real ports can't break a template which worked with placeholders,
+        # but check what will actually be loaded, while warming up.
+        final_check = nginx.check_config(service_replacements(running + list(others)))
+    except NginxConfigError as e:
+        print >>sys.stderr, "ERROR: Invalid nginx configuration, not deploying.\n%s" % e
+        stop_new_instances(services, running)
+        sys.exit(1)
+
+    with timeline.phase("warmup"):
+        failures = warm_up(running, timeline)
+
+    try:
+        with timeline.phase("validate"):
+            if final_check:
+                final_check.wait()
+    except NginxConfigError as e:
+        print >>sys.stderr, "ERROR: Invalid nginx configuration, not deploying.\n%s" % e
+        stop_new_instances(services, running)
+        sys.exit(1)
+
+    if failures:
+        for rs, e in failures:
+            print >>sys.stderr, "Unable to warm up %s. %s" % (rs.name, e)
+        stop_new_instances(services, running)
+        sys.exit(1)
+
+    return running
+
+def cut_over(config, services, nginx, running, timeline, drain, others=()):
+    """Make running the current generation, point nginx at it and stop the
+    previous instances of each service. others are the RunningServices of
+    services which are not being deployed, nginx keeps using them."""
     for service in services:
-        print "Starting new", service.name
-        service.start()
+        service.current_pids = [rs.pid for rs in running if rs.service is service]
+        write_int_list_file(service.current_pid_filename, service.current_pids)
 
-    # Wait for new services to spin up, and save their pids
-    replacements = {}
+    canary = Canary.from_config(config)
+    previous = [rs for service in services for rs in service.read_running(service.previous_pids)]
+
+    try:
+        if canary and previous:
+            if not shift_traffic(nginx, canary, running, previous, timeline, others):
+                with timeline.phase("roll_back"):
+                    stop_new_instances(services, running)
+                sys.exit(1)
+        else:
+            with timeline.phase("render"):
+                nginx.render_config(service_replacements(running + list(others)))
+            nginx.reconfig(timeline)
+    except NginxReloadError as e:
+        # Leave the previous instances running, nginx may still be using them.
+        print >>sys.stderr, "ERROR:", e
+        sys.exit(1)
+
+    # stop old processes, or keep them around for zddeploy rollback
+    retained = [service for service in services if service.retain_previous and service.previous_pids]
+    forget_retained([service for service in services if service not in retained])
+    for service in retained:
+        print "Keeping previous instances of %s for %ss, zddeploy rollback goes back to them." % (service.name, service.retain_previous)
+        deadline = "%.6f" % (time.time() + service.retain_previous)
+        write_retained_file(service.retained_pid_filename, dict((pid, deadline) for pid in service.previous_pids))
+        retire_later(service, service.previous_pids, deadline)
+
+    pids = dict((service, service.previous_pids) for service in services if service not in retained)
+    ports = dict((rs.pid, rs.port) for rs in previous)
+    if not stop_instances(services, pids, ports, "previous", timeline, drain):
+        sys.exit(1)
+
+def stop_instances(services, pids, ports, description, timeline, drain):
+    """Stop the instances in pids, which maps each service to a list of pids,
+    and follow them as they drain. ports maps pids to the port each one
+    listens on. Returns False if a stop command failed."""
+    stop_failed = False
+    drains = {}
+    for service in services:
+        if not pids.get(service):
+            continue
+        with timeline.phase("stop:%s" % service.name):
+            for pid in pids[service]:
+                print "Stopping %s instance of %s, process %s." % (description, service.name, pid)
+                try:
+                    service.stop(pid)
+                except CommandFailed as e:
+                    print >>sys.stderr, "ERROR: Unable to stop %s instance of %s. %s" % (description, service.name, e.describe())
+                    stop_failed = True
+                else:
+                    drains.setdefault(service, []).append(Drain(
+                        service.name, pid, ports.get(pid), service.drain_timeout, service.kill_timeout))
+
+    if drain == "wait":
+        def on_drained(instance):
+            timeline.record("drain:%s" % instance.name, instance.started, instance.finished)
+
+        def log(message):
+            print message
+
+        with timeline.phase("drain"):
+            drain_all([d for service in services for d in drains.get(service, [])], log, on_drained)
+    else:
+        for service, service_drains in drains.items():
+            drain_in_background(service_drains, service.output_file)
+
+    get_supervisor().reap()
+    return not stop_failed
+
+def forget_retained(services):
+    """Rollback undoes the last deploy only, so instances kept from an
+    earlier one are no longer a target. They are still retired on time."""
     for service in services:
-        rs = wait_for(service.read_port)
-        if not rs:
-            print >>sys.stderr, "Unable to start %s, timeout while waiting for port file." % service.name
+        try:
+            os.unlink(service.retained_pid_filename)
+        except OSError:
+            pass
+
+def retire_later(service, pids, deadline):
+    """Stop pids at deadline, the end of the service's retain_previous
+    window, from a detached process. Pids which have been rolled back to
+    by then are left alone, and so are those a later deploy retained again,
+    which are listed in the retained file with its own deadline."""
+    def retire(log):
+        time.sleep(max(0.0, float(deadline) - time.time()))
+        current = read_int_list_file(service.current_pid_filename)
+        retained = read_retained_file(service.retained_pid_filename)
+        mine = [pid for pid in pids if retained.get(pid, deadline) == deadline]
+        running = [rs for rs in service.read_running(mine) if rs.pid not in current]
+
+        # From here on rollback must not go back to them.
+        for pid in mine:
+            retained.pop(pid, None)
+        if retained:
+            write_retained_file(service.retained_pid_filename, retained)
+        else:
+            forget_retained([service])
+
+        drains = []
+        for rs in running:
+            log("Retiring previous instance of %s, process %s." % (service.name, rs.pid))
+            try:
+                service.stop(rs.pid)
+            except CommandFailed as e:
+                log("ERROR: Unable to stop previous instance of %s. %s" % (service.name, e.describe()))
+            else:
+                drains.append(Drain(service.name, rs.pid, rs.port, service.drain_timeout, service.kill_timeout))
+        drain_all(drains, log)
+
+    run_detached(service.output_file, retire)
+
+def running_instances(services, exclude=()):
+    """RunningServices for the current instances of services."""
+    return [rs for service in services for rs in service.read_running(service.instance_pids(exclude))]
+
+def deploy(config_file, timeline=None, drain="background", names=None):
+    """Deploy every service in config_file, or only those named in names.
+    With drain="wait", return once the previous instances have exited,
+    otherwise leave a background process to follow them."""
+    timeline = timeline or Timeline()
+
+    with timeline.phase("config"):
+        config, services, nginx = load_config(config_file)
+
+    selected = services
+    if names is not None:
+        unknown = set(names) - set(service.name for service in services)
+        if unknown:
+            print >>sys.stderr, "ERROR: No such service: %s" % " ".join(sorted(unknown))
             sys.exit(1)
+        selected = [service for service in services if service.name in names]
+
+    staged = discard_staged(selected)
+    budget = MemoryBudget.from_config(config)
+    if not budget:
+        others = running_instances([service for service in services if service not in selected], staged)
+        with timeline.phase("move_old_pidfiles"):
+            move_old_pidfiles(selected, staged)
 
-        print "%s succesfully started, process %s listening on port %s." % (service.name, rs.pid, rs.port)
+        running = start_new_generation(selected, nginx, timeline, others)
+        forget_retained([service for service in services if service not in selected])
+        cut_over(config, selected, nginx, running, timeline, drain, others)
+        return
 
-        replacements[service.name] = str(rs.port)
-        write_int_file(service.current_pid_filename, rs.pid)
+    pending = list(selected)
+    first_batch = True
+    while pending:
+        with timeline.phase("schedule"):
+            estimates = dict((service, service.memory_usage(staged)) for service in pending)
+            used = sum(service.memory_usage(staged, previous=True) for service in services)
+            room = budget.room(used)
+            batch = next_batch(pending, estimates, room)
+        pending = [service for service in pending if service not in batch]
+        print "Deploying %s, needing about %s of %s." % (
+            " ".join(service.name for service in batch),
+            format_size(sum(estimates[service] for service in batch)),
+            format_size(room) if room is not None else "unknown")
 
-    nginx = Nginx(config)
-    nginx.render_config(replacements)
-    nginx.reconfig()
+        others = running_instances([service for service in services if service not in batch], staged)
 
-    # wait for nginx to reconfig
-    # We could tail the error log set to info, but even then we'd need to know the # of worker processes
-    # both before and after the sighup (could change if the conf.template changes)
-    # The best option would be to either patch nginx, or write a plugin to get an authoritive answer.
-    time.sleep(1)
+        with timeline.phase("move_old_pidfiles"):
+            move_old_pidfiles(batch, staged)
+
+        running = start_new_generation(batch, nginx, timeline, others)
+        if first_batch:
+            forget_retained([service for service in services if service not in selected])
+            first_batch = False
+        # The next batch only fits once this one's previous instances are gone.
+        cut_over(config, batch, nginx, running, timeline, "wait" if pending else drain, others)
+
+def stage(config_file, timeline=None):
+    """Start and warm up a new generation of every service, without sending
+    it any requests. Its pids are saved to the staged pid files for promote()."""
+    timeline = timeline or Timeline()
+
+    with timeline.phase("config"):
+        config, services, nginx = load_config(config_file)
+
+    with timeline.phase("move_old_pidfiles"):
+        # The instances nginx uses stay current until promote.
+        collect_old_pids(services, discard_staged(services))
+        for service in services:
+            write_int_list_file(service.current_pid_filename, service.previous_pids)
+
+    running = start_new_generation(services, nginx, timeline)
 
-    # stop old processes
     for service in services:
-        if service.previous_pid is not None:
-            print "Stopping previous instance of %s, process %s." % (service.name, service.previous_pid)
-            service.stop(service.previous_pid)
+        service.current_pids, service.previous_pids = service.previous_pids, []
+        write_int_list_file(service.staged_pid_filename, [rs.pid for rs in running if rs.service is service])
+    get_supervisor().reap()
+    print "Staged %s, run zddeploy promote to send requests to it." % " ".join(rs.name for rs in running)
 
-def cli_deploy(argv):
-    parser = OptionParser()
+def promote(config_file, timeline=None, drain="background"):
+    """Point nginx at the generation started by stage(), and stop the one it replaces."""
+    timeline = timeline or Timeline()
+
+    with timeline.phase("config"):
+        config, services, nginx = load_config(config_file)
+
+    running = []
+    for service in services:
+        staged = read_int_list_file(service.staged_pid_filename)
+        service_running = service.read_running(staged)
+        if not staged or len(service_running) != len(staged):
+            print >>sys.stderr, "ERROR: No staged instances of %s are running, run zddeploy stage first." % service.name
+            sys.exit(1)
+        running.extend(service_running)
+
+    with timeline.phase("move_old_pidfiles"):
+        for service in services:
+            service.previous_pids = [pid for pid in read_int_list_file(service.current_pid_filename) if check_pid(pid)]
+            if service.previous_pids:
+                write_int_list_file(service.previous_pid_filename, service.previous_pids)
+            os.unlink(service.staged_pid_filename)
+
+    cut_over(config, services, nginx, running, timeline, drain)
+
+def rollback(config_file, timeline=None, drain="background"):
+    """Point nginx back at the previous instances kept alive by
+    retain_previous during the last deploy, and stop the ones which replaced
+    them. Services without retained instances are left as they are.
+    Nothing is started."""
+    timeline = timeline or Timeline()
+
+    with timeline.phase("config"):
+        config, services, nginx = load_config(config_file)
+
+    retained = []
+    rolled_back = []
+    for service in services:
+        service_retained = service.read_running(sorted(read_retained_file(service.retained_pid_filename)))
+        if service_retained:
+            retained.extend(service_retained)
+            rolled_back.append(service)
+    if not rolled_back:
+        print >>sys.stderr, "ERROR: No previous instances were kept by the last deploy, unable to roll back."
+        sys.exit(1)
+
+    others = running_instances([service for service in services if service not in rolled_back],
+                               [rs.pid for rs in retained])
+    try:
+        with timeline.phase("render"):
+            nginx.render_config(service_replacements(retained + others))
+        nginx.reconfig(timeline)
+    except NginxReloadError as e:
+        print >>sys.stderr, "ERROR:", e
+        sys.exit(1)
+
+    pids = {}
+    for service in rolled_back:
+        pids[service] = [pid for pid in read_int_list_file(service.current_pid_filename) if check_pid(pid)]
+        service.current_pids = [rs.pid for rs in retained if rs.service is service]
+        write_int_list_file(service.current_pid_filename, service.current_pids)
+        forget_retained([service])
+        try:
+            os.unlink(service.previous_pid_filename)
+        except OSError:
+            pass
+        print "Rolled %s back to process %s." % (service.name, " ".join(str(pid) for pid in service.current_pids))
+
+    current = [rs for service in rolled_back for rs in service.read_running(pids[service])]
+    if not stop_instances(rolled_back, pids, dict((rs.pid, rs.port) for rs in current), "rolled back", timeline, drain):
+        sys.exit(1)
+
+def deploy_option_parser(usage=None, drain=True):
+    """Options shared by the commands which deploy."""
+    parser = OptionParser(usage=usage)
 
     parser.add_option(
         "-c",
@@ -250,6 +1045,35 @@ def cli_deploy(argv):
         help="Enable verbose logging of the actions zdd takes.",
     )
 
+    parser.add_option(
+        "--report",
+        dest="report",
+        choices=["json"],
+        help="Print a timeline of the deploy's phases to stdout in FORMAT. Only json is supported.",
+        metavar="FORMAT",
+    )
+
+    parser.add_option(
+        "--history",
+        dest="history",
+        help="Append the deploy's timeline to FILENAME, for zddeploy stats.",
+        metavar="FILENAME",
+    )
+
+    if drain:
+        parser.add_option(
+            "--drain",
+            dest="drain",
+            choices=DRAIN_MODES,
+            default="background",
+            help="wait for the previous instances to drain and exit before returning, or follow them "
+                 "from a background process. [default %default]",
+            metavar="MODE",
+        )
+
+    return parser
+
+def parse_deploy_options(parser, argv):
     options, args = parser.parse_args(argv)
 
     settings.VERBOSE = options.verbose
@@ -258,6 +1082,95 @@ def cli_deploy(argv):
         print "ERROR: Unable to read zdd configuration file: %s" % options.deploy_conf
         print
         parser.print_help()
-        parser.exit()
+        parser.exit(1)
+
+    # The first argument is the program or command name.
+    return options, args[1:]
+
+def run_timed(options, action):
+    """Call action(timeline), then report and record the timeline as options ask."""
+    timeline = Timeline()
+    try:
+        action(timeline)
+    except BaseException:
+        timeline.finish(ok=False)
+        raise
+    else:
+        timeline.finish(ok=True)
+    finally:
+        if options.report == "json":
+            print timeline.to_json()
+        if options.history:
+            append_history(options.history, timeline)
+
+def cli_deploy(argv):
+    parser = deploy_option_parser("%prog [deploy] [options] [service ...]")
+    options, names = parse_deploy_options(parser, argv)
+    run_timed(options, lambda timeline: deploy(options.deploy_conf, timeline, options.drain, names or None))
+
+def cli_stage(argv):
+    options, args = parse_deploy_options(deploy_option_parser("%prog stage [options]", drain=False), argv)
+    run_timed(options, lambda timeline: stage(options.deploy_conf, timeline))
+
+def cli_promote(argv):
+    options, args = parse_deploy_options(deploy_option_parser("%prog promote [options]"), argv)
+    run_timed(options, lambda timeline: promote(options.deploy_conf, timeline, options.drain))
+
+def cli_rollback(argv):
+    options, args = parse_deploy_options(deploy_option_parser("%prog rollback [options]"), argv)
+    run_timed(options, lambda timeline: rollback(options.deploy_conf, timeline, options.drain))
+
+def cli_stats(argv):
+    parser = OptionParser(usage="%prog stats [options]")
+
+    parser.add_option(
+        "--history",
+        dest="history",
+        help="FILENAME of the deploy history written by zddeploy --history. [default %default]",
+        default="deploy_history.json",
+        metavar="FILENAME",
+    )
+
+    options, args = parser.parse_args(argv)
+
+    if not os.path.exists(options.history):
+        print "ERROR: Unable to read deploy history: %s" % options.history
+        parser.exit(1)
+
+    deploys = read_history(options.history)
+    if not deploys:
+        print "No deploys in %s." % options.history
+        return
+
+    print "%d deploys, %d failed." % (len(deploys), len([d for d in deploys if not d["ok"]]))
+    print format_stats(deploys)
+
+def cli_agent(argv):
+    # zdd.agent and zdd.fleet import this module, only load them when used.
+    from zdd.agent import cli_agent
+    return cli_agent(argv)
+
+def cli_ctl(argv):
+    from zdd.agent import cli_ctl
+    return cli_ctl(argv)
+
+def cli_fleet(argv):
+    from zdd.fleet import cli_fleet
+    return cli_fleet(argv)
+
+COMMANDS = {
+    "deploy": cli_deploy,
+    "stage": cli_stage,
+    "promote": cli_promote,
+    "rollback": cli_rollback,
+    "stats": cli_stats,
+    "agent": cli_agent,
+    "ctl": cli_ctl,
+    "fleet": cli_fleet,
+}
 
-    deploy(options.deploy_conf)
+def cli_main(argv):
+    """zddeploy [command] [options]. Without a command, deploys."""
+    if len(argv) > 1 and argv[1] in COMMANDS:
+        return COMMANDS[argv[1]](argv[1:])
+    return cli_deploy(argv)
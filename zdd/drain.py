@@ -0,0 +1,138 @@
+"""Follow the previous instances of a service while they drain.
+
+Once nginx has moved to the new instances, each previous one is sent its
+stop command and should finish the requests it has in flight and exit. We
+count the established connections it and its children still hold on its
+port, through /proc, and give it drain_timeout seconds. After that it gets
+SIGTERM, and kill_timeout seconds later SIGKILL, along with its children.
+"""
+from __future__ import with_statement
+
+import os
+import signal
+import subprocess
+import time
+
+from zdd.proc import proc_available, is_alive, descendant_pids, established_connections
+
+DEFAULT_DRAIN_TIMEOUT = 300.0
+DEFAULT_KILL_TIMEOUT = 10.0
+DRAIN_POLL_INTERVAL = 0.5
+
+def pid_alive(pid):
+    if proc_available():
+        return is_alive(pid)
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+def kill(pid, signum):
+    try:
+        os.kill(pid, signum)
+    except OSError:
+        pass
+
+class Drain(object):
+    """A previous instance which has been sent its stop command."""
+
+    def __init__(self, name, pid, port, timeout=DEFAULT_DRAIN_TIMEOUT, kill_timeout=DEFAULT_KILL_TIMEOUT):
+        self.name = name
+        self.pid = pid
+        # Only connections on port count, or all of them if it is unknown.
+        self.port = port
+        self.timeout = timeout
+        self.kill_timeout = kill_timeout
+        self.started = time.time()
+        self.finished = None
+        self.connections = None
+        # The last signal we escalated to, if any.
+        self.signal = None
+
+    def poll(self, log):
+        """Count connections, and signal the instance if it is past its
+        deadline. Returns True once it has exited."""
+        if self.finished is not None:
+            return True
+
+        now = time.time()
+        if not pid_alive(self.pid):
+            self.finished = now
+            return True
+
+        pids = descendant_pids(self.pid) if proc_available() else set([self.pid])
+        connections = established_connections(pids, self.port)
+        if connections != self.connections:
+            self.connections = connections
+            log("%s still has %d connections open after %.1fs." % (self.label, connections, now - self.started))
+
+        elapsed = now - self.started
+        if elapsed >= self.timeout + self.kill_timeout and self.signal != signal.SIGKILL:
+            log("%s did not exit %ss after SIGTERM, sending SIGKILL to %s." % (
+                self.label, self.kill_timeout, " ".join(str(pid) for pid in sorted(pids))))
+            self.signal = signal.SIGKILL
+            for pid in pids:
+                kill(pid, signal.SIGKILL)
+        elif elapsed >= self.timeout and self.signal is None:
+            log("%s did not drain within %ss, sending SIGTERM." % (self.label, self.timeout))
+            self.signal = signal.SIGTERM
+            kill(self.pid, signal.SIGTERM)
+        return False
+
+    @property
+    def label(self):
+        return "%s process %s" % (self.name, self.pid)
+
+    @property
+    def duration(self):
+        return (self.finished or time.time()) - self.started
+
+def drain_all(drains, log, on_drained=None, interval=DRAIN_POLL_INTERVAL):
+    """Poll drains until every instance has exited, calling on_drained(drain) as each one does."""
+    pending = list(drains)
+    while pending:
+        for drain in list(pending):
+            if drain.poll(log):
+                pending.remove(drain)
+                log("%s drained in %.1fs%s." % (
+                    drain.label, drain.duration, " (killed)" if drain.signal == signal.SIGKILL else ""))
+                if on_drained:
+                    on_drained(drain)
+        if pending:
+            time.sleep(interval)
+
+def run_detached(log_filename, action):
+    """Call action(log) in a detached process which carries on after we exit,
+    appending what it logs to log_filename."""
+    pid = os.fork()
+    if pid:
+        # The intermediate child exits right away, leaving the detached one to init.
+        os.waitpid(pid, 0)
+        return
+
+    try:
+        os.setsid()
+        if os.fork():
+            os._exit(0)
+
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        null = os.open(os.devnull, os.O_RDWR)
+        log_fd = os.open(log_filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        os.dup2(null, 0)
+        os.dup2(log_fd, 1)
+        os.dup2(log_fd, 2)
+        # Don't hold on to anything of the parent's, such as the agent's
+        # listening socket, which would keep answering after it is gone.
+        os.closerange(3, subprocess.MAXFD)
+
+        def log(message):
+            os.write(1, "%s zdd: %s\n" % (time.strftime("%Y-%m-%d %H:%M:%S"), message))
+
+        action(log)
+    finally:
+        os._exit(0)
+
+def drain_in_background(drains, log_filename):
+    """Follow drains from a detached process, logging to log_filename."""
+    run_detached(log_filename, lambda log: drain_all(drains, log))
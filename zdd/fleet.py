@@ -0,0 +1,340 @@
+"""Deploy to many hosts at once.
+
+A fleet file lists the targets, each a deploy.conf on some host and how to
+run zddeploy there: over ssh, or as a local subprocess, which is handy for
+trying a rollout with several deploy.conf directories on one machine::
+
+  [fleet]
+  max_in_flight: 4
+  batch_size: 8
+
+  [target:web1]
+  transport: ssh
+  host: web1.example.com
+  conf: /srv/app/deploy.conf
+
+  [target:local]
+  transport: local
+  conf: ./hosts/one/deploy.conf
+
+Targets are deployed in batches, in the order of the file, with at most
+max_in_flight deploys running at once. Once a deploy fails no more are
+started, the ones in flight are waited for, and the rollout stops.
+"""
+from __future__ import with_statement
+
+from optparse import OptionParser
+import json
+import os
+import pipes
+import subprocess
+import sys
+import threading
+import time
+
+from zdd.deploy import DeployConfigParser, DRAIN_MODES
+from zdd.supervise import describe_returncode, tail_lines
+
+FLEET_SECTION = "fleet"
+TARGET_PREFIX = "target:"
+TRANSPORTS = ("ssh", "local")
+DEFAULT_MAX_IN_FLIGHT = 4
+DEFAULT_TIMEOUT = 600.0
+
+class Target(object):
+    def __init__(self, config, section, local_command):
+        assert section.startswith(TARGET_PREFIX)
+        self.name = section[len(TARGET_PREFIX):]
+        self.transport = config.get_default(section, "transport", "ssh")
+        assert self.transport in TRANSPORTS, "transport must be one of " + ", ".join(TRANSPORTS)
+
+        if self.transport == "ssh":
+            self.host = config.get_default(section, "host", self.name)
+            # A path on the host, not relative to the fleet file
+            self.conf = config.get(section, "conf")
+            self.command = config.get_default(section, "command", "zddeploy").split(' ')
+        else:
+            self.host = None
+            self.conf = config.get_path(section, "conf")
+            command = config.get_default(section, "command")
+            self.command = command.split(' ') if command else local_command
+
+    def deploy_command(self, args=()):
+        """The command which runs zddeploy for this target, and prints its timeline as its last line."""
+        command = self.command + ["deploy", "-c", self.conf, "--report", "json"] + list(args)
+        if self.transport == "ssh":
+            return ["ssh", "-o", "BatchMode=yes", self.host, " ".join(pipes.quote(arg) for arg in command)]
+        return command
+
+class TargetResult(object):
+    def __init__(self, target):
+        self.target = target
+        self.started = None
+        self.finished = None
+        self.returncode = None
+        self.output = ""
+        self.timed_out = False
+        # The deploy's timeline as reported by zddeploy, if it got that far
+        self.timeline = None
+
+    @property
+    def skipped(self):
+        return self.started is None
+
+    @property
+    def ok(self):
+        """Only if zddeploy exited successfully and reported a successful deploy."""
+        return self.returncode == 0 and bool(self.timeline) and self.timeline.get("ok") is True
+
+    @property
+    def duration(self):
+        if self.skipped:
+            return None
+        return self.finished - self.started
+
+    def describe(self):
+        if self.skipped:
+            return "skipped"
+        if self.timed_out:
+            return "timed out"
+        if self.returncode is None:
+            return "unable to run"
+        if self.returncode != 0:
+            return describe_returncode(self.returncode)
+        if not self.timeline:
+            return "no deploy timeline reported"
+        if not self.ok:
+            return "deploy reported failure"
+        return "ok"
+
+    def to_dict(self):
+        return {
+            "target": self.target.name,
+            "ok": self.ok,
+            "status": self.describe(),
+            "duration": self.duration,
+            "timeline": self.timeline,
+        }
+
+def parse_timeline(output):
+    """The JSON timeline zddeploy --report json prints last, or None."""
+    for line in reversed(output.splitlines()):
+        line = line.strip()
+        if line.startswith("{"):
+            try:
+                return json.loads(line)
+            except ValueError:
+                return None
+    return None
+
+def run_target(target, args=(), timeout=DEFAULT_TIMEOUT):
+    """Deploy target, returning its TargetResult."""
+    result = TargetResult(target)
+    result.started = time.time()
+    command = target.deploy_command(args)
+    try:
+        with file(os.devnull, 'r') as devnull:
+            process = subprocess.Popen(command, stdin=devnull, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                       close_fds=True)
+    except OSError as e:
+        result.output = "Unable to run %s: %s" % (command[0], e)
+        result.finished = time.time()
+        return result
+
+    def kill():
+        result.timed_out = True
+        try:
+            process.kill()
+        except OSError:
+            pass
+
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    try:
+        result.output = process.communicate()[0]
+    finally:
+        timer.cancel()
+
+    result.finished = time.time()
+    result.returncode = process.returncode
+    result.timeline = parse_timeline(result.output)
+    return result
+
+def batches(targets, batch_size):
+    for start in xrange(0, len(targets), batch_size):
+        yield targets[start:start + batch_size]
+
+def run_batch(targets, max_in_flight, args, timeout, on_result):
+    """Deploy targets with at most max_in_flight at once, starting no more
+    once one has failed. Returns their TargetResults, in order."""
+    results = [TargetResult(target) for target in targets]
+    lock = threading.Lock()
+    pending = list(enumerate(targets))
+    failed = []
+
+    def worker():
+        while True:
+            with lock:
+                if failed or not pending:
+                    return
+                index, target = pending.pop(0)
+            result = results[index] = run_target(target, args, timeout)
+            with lock:
+                if not result.ok:
+                    failed.append(result)
+                on_result(result)
+
+    threads = [threading.Thread(target=worker) for _ in xrange(min(max_in_flight, len(targets)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def rollout(targets, max_in_flight=DEFAULT_MAX_IN_FLIGHT, batch_size=None, args=(), timeout=DEFAULT_TIMEOUT,
+            on_result=lambda result: None, on_batch=lambda number, batch: None):
+    """Deploy targets batch by batch, stopping after the first batch with
+    a failure. Returns a TargetResult for every target, skipped ones included."""
+    results = []
+    stopped = False
+    for number, batch in enumerate(batches(targets, batch_size or max_in_flight)):
+        if stopped:
+            results.extend(TargetResult(target) for target in batch)
+            continue
+        on_batch(number + 1, batch)
+        batch_results = run_batch(batch, max_in_flight, args, timeout, on_result)
+        results.extend(batch_results)
+        stopped = not all(result.ok for result in batch_results)
+    return results
+
+def format_result(result):
+    line = "%s: %s" % (result.target.name, result.describe())
+    if result.skipped:
+        return line
+    line += " in %.2fs" % result.duration
+    if result.timeline:
+        phases = {}
+        for phase in result.timeline["phases"]:
+            phases[phase["name"]] = phases.get(phase["name"], 0.0) + phase["duration"]
+        details = ["deploy %.2fs" % result.timeline["duration"]]
+        if "ready" in phases:
+            details.append("ready %.2fs" % phases["ready"])
+        if "reload" in phases:
+            details.append("reload %.0fms" % ((phases["reload"] + phases.get("reload_confirm", 0.0)) * 1000))
+        line += " (%s)" % ", ".join(details)
+    if not result.ok:
+        output = "\n".join(output_line for output_line in result.output.splitlines() if not output_line.startswith("{"))
+        line += "\n" + "\n".join("    " + output_line for output_line in tail_lines(output))
+    return line
+
+def format_summary(results, duration):
+    done = [result for result in results if not result.skipped]
+    durations = sorted(result.duration for result in done)
+    lines = ["%d targets: %d deployed, %d failed, %d skipped in %.2fs." % (
+        len(results), len([result for result in done if result.ok]),
+        len([result for result in done if not result.ok]),
+        len(results) - len(done), duration)]
+    if durations:
+        lines.append("Per target: fastest %.2fs, slowest %.2fs (%s)." % (
+            durations[0], durations[-1], max(done, key=lambda result: result.duration).target.name))
+    return "\n".join(lines)
+
+def load_targets(config, local_command):
+    return [Target(config, section, local_command)
+            for section in config.sections() if section.startswith(TARGET_PREFIX)]
+
+def cli_fleet(argv):
+    parser = OptionParser(usage="%prog fleet [options] [target ...]")
+
+    parser.add_option(
+        "-f",
+        "--fleet",
+        dest="fleet",
+        help="FILENAME listing the targets. [default %default]",
+        default="fleet.conf",
+        metavar="FILENAME",
+    )
+
+    parser.add_option(
+        "--max-in-flight",
+        dest="max_in_flight",
+        type="int",
+        help="Deploy to at most N targets at once. [default max_in_flight in the fleet file, or %d]" % DEFAULT_MAX_IN_FLIGHT,
+        metavar="N",
+    )
+
+    parser.add_option(
+        "--batch-size",
+        dest="batch_size",
+        type="int",
+        help="Targets in each batch, the rollout stops after a batch with a failure. "
+             "[default batch_size in the fleet file, or max-in-flight]",
+        metavar="N",
+    )
+
+    parser.add_option(
+        "--drain",
+        dest="drain",
+        choices=DRAIN_MODES,
+        help="Passed on to zddeploy on each target.",
+        metavar="MODE",
+    )
+
+    parser.add_option(
+        "--report",
+        dest="report",
+        choices=["json"],
+        help="Print the result of every target to stdout in FORMAT when done. Only json is supported.",
+        metavar="FORMAT",
+    )
+
+    options, args = parser.parse_args(argv)
+    names = args[1:]
+
+    if not os.path.exists(options.fleet):
+        print "ERROR: Unable to read fleet file: %s" % options.fleet
+        print
+        parser.print_help()
+        parser.exit(1)
+
+    config = DeployConfigParser()
+    config.read(options.fleet)
+
+    # Local targets run the same zddeploy as we are.
+    local_command = [sys.executable, os.path.abspath(sys.argv[0])]
+    targets = load_targets(config, local_command)
+    if names:
+        unknown = set(names) - set(target.name for target in targets)
+        if unknown:
+            print >>sys.stderr, "ERROR: No such target: %s" % " ".join(sorted(unknown))
+            sys.exit(1)
+        targets = [target for target in targets if target.name in names]
+    if not targets:
+        print >>sys.stderr, "ERROR: No targets in %s." % options.fleet
+        sys.exit(1)
+
+    max_in_flight = options.max_in_flight or int(config.get_default(FLEET_SECTION, "max_in_flight", DEFAULT_MAX_IN_FLIGHT))
+    batch_size = options.batch_size or int(config.get_default(FLEET_SECTION, "batch_size", max_in_flight))
+    timeout = config.getfloat_default(FLEET_SECTION, "timeout", DEFAULT_TIMEOUT)
+    deploy_args = ["--drain", options.drain] if options.drain else []
+
+    def on_batch(number, batch):
+        print "Batch %d: %s" % (number, " ".join(target.name for target in batch))
+        sys.stdout.flush()
+
+    def on_result(result):
+        print format_result(result)
+        sys.stdout.flush()
+
+    started = time.time()
+    results = rollout(targets, max_in_flight, batch_size, deploy_args, timeout, on_result, on_batch)
+
+    for result in results:
+        if result.skipped:
+            print format_result(result)
+    print format_summary(results, time.time() - started)
+    if options.report == "json":
+        print json.dumps([result.to_dict() for result in results], sort_keys=True)
+
+    if not all(result.ok for result in results):
+        sys.exit(1)
@@ -0,0 +1,189 @@
+"""Helpers for inspecting and controlling processes on Linux, mostly through /proc."""
+from __future__ import with_statement
+
+import ctypes
+import ctypes.util
+import errno
+import multiprocessing
+import os
+
+PROC = "/proc"
+
+def proc_available():
+    return os.path.isdir(os.path.join(PROC, "self"))
+
+def read_stat(pid):
+    """Fields of /proc/<pid>/stat after the command name, or None if pid is gone.
+
+    The command name is wrapped in parentheses and may itself contain spaces
+    or parentheses, so we split after the last closing parenthesis. The
+    first returned field is the state, the second the parent pid.
+    """
+    try:
+        with file(os.path.join(PROC, str(pid), "stat"), 'r') as stat_file:
+            stat = stat_file.read()
+    except (IOError, OSError):
+        return None
+    return stat[stat.rindex(")") + 2:].split()
+
+def is_alive(pid):
+    """True unless pid is gone or a zombie waiting to be reaped."""
+    fields = read_stat(pid)
+    return fields is not None and fields[0] != "Z"
+
+def child_pids(pid):
+    """Set of live pids whose parent is pid."""
+    try:
+        # Only present with CONFIG_PROC_CHILDREN, but much cheaper than a scan.
+        with file(os.path.join(PROC, str(pid), "task", str(pid), "children"), 'r') as children_file:
+            return set(int(child) for child in children_file.read().split() if is_alive(child))
+    except (IOError, OSError):
+        pass
+
+    children = set()
+    for entry in os.listdir(PROC):
+        if not entry.isdigit():
+            continue
+        fields = read_stat(entry)
+        if fields and fields[0] != "Z" and int(fields[1]) == pid:
+            children.add(int(entry))
+    return children
+
+def _libc():
+    libc_name = ctypes.util.find_library("c")
+    if not libc_name:
+        raise OSError(errno.ENOSYS, "libc not found")
+    return ctypes.CDLL(libc_name, use_errno=True)
+
+def _cpu_mask():
+    """An empty cpu_set_t, a bitmask of 1024 cpus, and the bits in each of its words."""
+    bits = 8 * ctypes.sizeof(ctypes.c_ulong)
+    return (ctypes.c_ulong * (1024 / bits))(), bits
+
+def set_cpu_affinity(cpus, pid=0):
+    """Pin pid (0 for the calling process) to the given cpu numbers."""
+    libc = _libc()
+    mask, bits = _cpu_mask()
+    for cpu in cpus:
+        mask[cpu / bits] |= 1 << (cpu % bits)
+
+    if libc.sched_setaffinity(pid, ctypes.sizeof(mask), ctypes.byref(mask)) != 0:
+        raise OSError(ctypes.get_errno(), "sched_setaffinity failed")
+
+def parse_cpu_list(cpu_list):
+    """Cpu numbers of a list such as "0-3,8,10-11", as in Cpus_allowed_list."""
+    cpus = []
+    for part in cpu_list.strip().split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            cpus.extend(range(int(first), int(last) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+def allowed_cpus():
+    """Sorted cpu numbers we may run on, which in a container or under
+    taskset can be far fewer than the host has. All of them if unknown."""
+    try:
+        libc = _libc()
+        mask, bits = _cpu_mask()
+        if libc.sched_getaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)) == 0:
+            return [cpu for cpu in xrange(len(mask) * bits) if mask[cpu / bits] & (1 << (cpu % bits))]
+    except (OSError, AttributeError):
+        pass
+
+    try:
+        with file(os.path.join(PROC, "self", "status"), 'r') as status:
+            for line in status:
+                if line.startswith("Cpus_allowed_list:"):
+                    cpus = parse_cpu_list(line.split(":", 1)[1])
+                    if cpus:
+                        return cpus
+    except (IOError, OSError, ValueError):
+        pass
+    return range(multiprocessing.cpu_count())
+
+def descendant_pids(pid):
+    """pid and all of its children, grandchildren and so on."""
+    found = set([pid])
+    pending = [pid]
+    while pending:
+        for child in child_pids(pending.pop()):
+            if child not in found:
+                found.add(child)
+                pending.append(child)
+    return found
+
+def socket_inodes(pid):
+    """Inodes of the sockets pid has open."""
+    inodes = set()
+    fd_dir = os.path.join(PROC, str(pid), "fd")
+    try:
+        fds = os.listdir(fd_dir)
+    except OSError:
+        return inodes
+
+    for fd in fds:
+        try:
+            target = os.readlink(os.path.join(fd_dir, fd))
+        except OSError:
+            continue
+        if target.startswith("socket:["):
+            inodes.add(int(target[len("socket:["):-1]))
+    return inodes
+
+TCP_ESTABLISHED = "01"
+
+def established_connections(pids, port=None):
+    """Number of established TCP connections held by any of pids, only
+    counting those on local port if given."""
+    inodes = set()
+    for pid in pids:
+        inodes |= socket_inodes(pid)
+    if not inodes:
+        return 0
+
+    count = 0
+    for table in ("tcp", "tcp6"):
+        try:
+            with file(os.path.join(PROC, "net", table), 'r') as tcp:
+                lines = tcp.readlines()[1:]
+        except (IOError, OSError):
+            continue
+
+        for line in lines:
+            # sl local_address rem_address st tx_queue:rx_queue tr:tm->when retrnsmt uid timeout inode
+            fields = line.split()
+            if fields[3] != TCP_ESTABLISHED or int(fields[9]) not in inodes:
+                continue
+            if port is not None and int(fields[1].rsplit(":", 1)[1], 16) != port:
+                continue
+            count += 1
+    return count
+
+def rss(pid):
+    """Resident set size of pid in bytes, 0 if it is gone."""
+    try:
+        with file(os.path.join(PROC, str(pid), "statm"), 'r') as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, IndexError, ValueError):
+        return 0
+
+def tree_rss(pid):
+    """Resident set size of pid and all of its descendants, in bytes. Pages
+    they share, such as those of forked workers, are counted once for each."""
+    return sum(rss(descendant) for descendant in descendant_pids(pid))
+
+def available_memory():
+    """Bytes of memory available for new processes without swapping, from
+    /proc/meminfo, or None if it can't be read."""
+    try:
+        with file(os.path.join(PROC, "meminfo"), 'r') as meminfo:
+            fields = dict((line.split(":")[0], int(line.split()[1]) * 1024) for line in meminfo if line.strip())
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+
+    if "MemAvailable" in fields:
+        return fields["MemAvailable"]
+    # Kernels before 3.14 don't estimate it.
+    return fields.get("MemFree", 0) + fields.get("Cached", 0)
@@ -0,0 +1,180 @@
+"""Wait for many services to become ready at once.
+
+A service is ready once its pid file and port file exist. Rather than
+polling each service in turn, we watch the directories holding those files
+with inotify and re-check whenever something in them is written. On systems
+without inotify we fall back to polling.
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import time
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+POLL_INTERVAL = 0.1
+
+# Even with inotify we re-check this often, in case a pid file appears for a
+# process that has since died, or an event was missed.
+FALLBACK_INTERVAL = 1.0
+
+class ReadinessError(Exception):
+    def __init__(self, message, targets, ready=()):
+        self.targets = targets
+        # Results of the targets which did become ready
+        self.ready = list(ready)
+        Exception.__init__(self, message)
+
+class ReadinessTimeout(ReadinessError):
+    def __init__(self, targets, ready=()):
+        ReadinessError.__init__(self, "Timed out waiting for %s" % ", ".join(target.name for target in targets), targets, ready)
+
+class ReadinessFailed(ReadinessError):
+    def __init__(self, target, reason, ready=()):
+        self.reason = reason
+        ReadinessError.__init__(self, "%s failed: %s" % (target.name, reason), [target], ready)
+
+def drain_fd(fd):
+    try:
+        while os.read(fd, 4096):
+            pass
+    except OSError as e:
+        if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+            raise
+
+class InotifyWatcher(object):
+    """Wakes up when a file is created or written in any of the watched directories."""
+
+    def __init__(self, directories):
+        libc_name = ctypes.util.find_library("c")
+        if not libc_name:
+            raise OSError(errno.ENOSYS, "libc not found")
+
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        try:
+            inotify_init1 = libc.inotify_init1
+            inotify_add_watch = libc.inotify_add_watch
+        except AttributeError:
+            raise OSError(errno.ENOSYS, "inotify not available")
+
+        # IN_NONBLOCK has the same value as O_NONBLOCK
+        self.fd = inotify_init1(os.O_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        for directory in set(directories):
+            if inotify_add_watch(self.fd, directory, WATCH_MASK) < 0:
+                error = ctypes.get_errno()
+                os.close(self.fd)
+                raise OSError(error, "inotify_add_watch failed for %s" % directory)
+
+    def fileno(self):
+        return self.fd
+
+    def wait(self, timeout, extra_fds=()):
+        """Block until a watched directory changes, an extra fd is readable
+        or timeout seconds pass. Returns the list of readable extra fds."""
+        timeout = min(timeout, FALLBACK_INTERVAL)
+        try:
+            readable, _, _ = select.select([self.fd] + list(extra_fds), [], [], timeout)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return []
+
+        if self.fd in readable:
+            # We don't care which file changed, only that something did.
+            drain_fd(self.fd)
+            readable.remove(self.fd)
+        return readable
+
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher(object):
+    """Fallback for systems without inotify."""
+
+    def __init__(self, interval=POLL_INTERVAL):
+        self.interval = interval
+
+    def wait(self, timeout, extra_fds=()):
+        timeout = min(timeout, self.interval)
+        try:
+            readable, _, _ = select.select(list(extra_fds), [], [], timeout)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return []
+        return readable
+
+    def close(self):
+        pass
+
+def make_watcher(directories):
+    try:
+        return InotifyWatcher(directories)
+    except OSError:
+        return PollingWatcher()
+
+def wait_for_all(targets, on_ready=None, wake_fds=()):
+    """Wait for every target to become ready, all at the same time.
+
+    Each target must have a ``name``, a ``ready_timeout`` in seconds, a
+    ``watch_directory``, a ``read_port()`` method which returns None until
+    the target is ready, and a ``failure()`` method which returns why the
+    target can never become ready, or None. Returns the results of
+    ``read_port()`` in the same order as targets. ``on_ready(target,
+    result)`` is called as soon as each target becomes ready.
+
+    wake_fds are non-blocking pipes which are written to when a target may
+    have failed, such as the Supervisor's. They are drained on every wake up.
+
+    Raises ReadinessFailed as soon as any target fails, and ReadinessTimeout
+    as soon as any target runs past its ready_timeout, without waiting for
+    the others.
+    """
+    start = time.time()
+    results = [None] * len(targets)
+    pending = dict((index, start + target.ready_timeout) for index, target in enumerate(targets))
+
+    # The watcher must exist before the first check, so that a file written
+    # between the check and the wait still wakes us up.
+    watcher = make_watcher([target.watch_directory for target in targets])
+    try:
+        while pending:
+            now = time.time()
+            timed_out = []
+            for index, deadline in sorted(pending.items()):
+                result = targets[index].read_port()
+                if result is not None:
+                    results[index] = result
+                    del pending[index]
+                    if on_ready:
+                        on_ready(targets[index], result)
+                    continue
+
+                reason = targets[index].failure()
+                if reason:
+                    raise ReadinessFailed(targets[index], reason, [result for result in results if result is not None])
+                if now >= deadline:
+                    timed_out.append(targets[index])
+
+            if timed_out:
+                raise ReadinessTimeout(timed_out, [result for result in results if result is not None])
+
+            if pending:
+                for fd in watcher.wait(max(0, min(pending.values()) - time.time()), wake_fds):
+                    drain_fd(fd)
+    finally:
+        watcher.close()
+
+    return results
@@ -0,0 +1,96 @@
+"""Timing of each phase of a deploy, and statistics across past deploys."""
+from __future__ import with_statement
+
+from contextlib import contextmanager
+import json
+import time
+
+from zdd.stats import percentile
+
+class Timeline(object):
+    """Records how long each phase of a deploy took."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.finished = None
+        self.ok = None
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.time())
+
+    def record(self, name, start, end):
+        self.phases.append((name, start, end))
+
+    def finish(self, ok):
+        self.finished = time.time()
+        self.ok = ok
+
+    def to_dict(self):
+        finished = self.finished or time.time()
+        return {
+            "started": self.started,
+            "duration": finished - self.started,
+            "ok": self.ok,
+            "phases": [
+                {"name": name, "start": start - self.started, "duration": end - start}
+                for name, start, end in self.phases
+            ],
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), sort_keys=True)
+
+def append_history(filename, timeline):
+    """Append timeline to a history file, one JSON deploy per line."""
+    with file(filename, 'a') as history:
+        history.write(timeline.to_json() + "\n")
+
+def read_history(filename):
+    deploys = []
+    with file(filename, 'r') as history:
+        for line in history:
+            line = line.strip()
+            if line:
+                deploys.append(json.loads(line))
+    return deploys
+
+def phase_durations(deploys):
+    """Map each phase name to its duration in every deploy it appears in.
+
+    Phases which appear several times in one deploy, like the nginx reload
+    of each canary step, are summed. Returns the names in the order they
+    first appear along with the map.
+    """
+    order = []
+    durations = {}
+    for deploy in deploys:
+        totals = {}
+        for phase in deploy["phases"]:
+            name = phase["name"]
+            if name not in durations:
+                order.append(name)
+                durations[name] = []
+            totals[name] = totals.get(name, 0.0) + phase["duration"]
+        for name, total in totals.items():
+            durations[name].append(total)
+
+    order.append("total")
+    durations["total"] = [deploy["duration"] for deploy in deploys]
+    return order, durations
+
+def format_stats(deploys):
+    order, durations = phase_durations(deploys)
+    width = max(len(name) for name in order)
+
+    lines = ["%-*s %6s %10s %10s" % (width, "phase", "count", "p50", "p95")]
+    for name in order:
+        values = durations[name]
+        lines.append("%-*s %6d %9.1fms %9.1fms" % (
+            width, name, len(values), percentile(values, 50) * 1000, percentile(values, 95) * 1000))
+    return "\n".join(lines)
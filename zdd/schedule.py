@@ -0,0 +1,68 @@
+"""Split a deploy into batches of services which fit in memory.
+
+While a service is deployed its previous and new instances run side by
+side, so deploying everything at once needs about twice the memory the
+services normally use. With a [deploy] section giving a memory_budget for
+all the services together, or a memory_headroom to leave free, services are
+deployed in batches: each batch is started, cut over and drained before the
+next one starts. A service's new instances are expected to use as much
+memory as its current ones.
+"""
+from zdd.proc import available_memory
+
+DEPLOY_SECTION = "deploy"
+SIZE_SUFFIXES = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+def parse_size(text):
+    """Bytes in a size like 512M, 2G or 1048576."""
+    text = text.strip().upper()
+    if text.endswith("B"):
+        text = text[:-1]
+    if text and text[-1] in SIZE_SUFFIXES:
+        return int(float(text[:-1]) * SIZE_SUFFIXES[text[-1]])
+    return int(text)
+
+def format_size(size):
+    return "%.0fM" % (size / float(SIZE_SUFFIXES["M"]))
+
+class MemoryBudget(object):
+    def __init__(self, budget=None, headroom=None):
+        assert budget is not None or headroom is not None
+        self.budget = budget
+        self.headroom = headroom
+
+    @classmethod
+    def from_config(cls, config):
+        """The MemoryBudget of the [deploy] section, or None without one."""
+        if not config.has_section(DEPLOY_SECTION):
+            return None
+        budget = config.get_default(DEPLOY_SECTION, "memory_budget")
+        headroom = config.get_default(DEPLOY_SECTION, "memory_headroom")
+        if budget is None and headroom is None:
+            return None
+        return cls(parse_size(budget) if budget else None, parse_size(headroom) if headroom else None)
+
+    def room(self, used):
+        """Bytes new instances may use, given the services already use used
+        bytes. The smaller of the two if both a budget and a headroom are set."""
+        rooms = []
+        if self.budget is not None:
+            rooms.append(self.budget - used)
+        if self.headroom is not None:
+            available = available_memory()
+            if available is not None:
+                rooms.append(available - self.headroom)
+        return max(0, min(rooms)) if rooms else None
+
+def next_batch(pending, estimates, room):
+    """The services out of pending, in order, whose estimated memory fits in
+    room together. The first one is always included, even alone too big,
+    since it has to be deployed at some point."""
+    batch = []
+    total = 0
+    for service in pending:
+        if batch and room is not None and total + estimates[service] > room:
+            continue
+        batch.append(service)
+        total += estimates[service]
+    return batch
@@ -0,0 +1,12 @@
+"""Small statistics helpers, to avoid depending on numpy."""
+
+import math
+
+def percentile(values, pct):
+    """The pct-th percentile of values, using the nearest-rank method.
+    Returns None for an empty sequence."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(ordered)))
+    return ordered[max(rank - 1, 0)]
@@ -0,0 +1,141 @@
+"""Keep track of the processes zdd starts.
+
+Every child is spawned through the Supervisor, which keeps its handle, reaps
+it, and notices as soon as it exits: a SIGCHLD handler writes to a pipe that
+the readiness wait selects on. A child's stdout and stderr go to an output
+file rather than a pipe, since servers outlive zddeploy and would get EPIPE
+writing to a pipe nobody reads. The last lines a child wrote can be read
+back from there when it crashes.
+"""
+from __future__ import with_statement
+
+from collections import deque
+import errno
+import fcntl
+import os
+import signal
+import subprocess
+
+OUTPUT_LINES = 20
+# Never read more than this much of an output file to find its last lines.
+OUTPUT_TAIL_BYTES = 64 * 1024
+
+def set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+def describe_returncode(returncode):
+    if returncode < 0:
+        return "killed by signal %d" % -returncode
+    return "exit status %d" % returncode
+
+def tail_lines(text, lines=OUTPUT_LINES):
+    return list(deque(text.splitlines(), maxlen=lines))
+
+class Child(object):
+    """A spawned process whose output is appended to output_filename."""
+
+    def __init__(self, name, command, output_filename, **kwargs):
+        self.name = name
+        self.command = command
+        self.output_filename = output_filename
+
+        with file(output_filename, 'a') as output:
+            output.seek(0, os.SEEK_END)
+            self.offset = output.tell()
+            with file(os.devnull, 'r') as devnull:
+                self.process = subprocess.Popen(command, stdin=devnull, stdout=output, stderr=subprocess.STDOUT,
+                                                close_fds=True, **kwargs)
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def poll(self):
+        """Reap the process if it has exited. Returns its returncode, or None if still running."""
+        return self.process.poll()
+
+    @property
+    def crashed(self):
+        """True if the process exited unsuccessfully. Servers which
+        daemonize exit 0 right away, that doesn't count."""
+        returncode = self.poll()
+        return returncode is not None and returncode != 0
+
+    def output_tail(self, lines=OUTPUT_LINES):
+        """The last lines written since this child was spawned."""
+        try:
+            with file(self.output_filename, 'r') as output:
+                output.seek(0, os.SEEK_END)
+                output.seek(max(self.offset, output.tell() - OUTPUT_TAIL_BYTES))
+                return tail_lines(output.read(), lines)
+        except (IOError, OSError):
+            return []
+
+    def describe(self):
+        lines = ["%s (process %s) %s." % (self.name, self.pid, describe_returncode(self.poll()))]
+        tail = self.output_tail()
+        if tail:
+            lines.append("Last output in %s:" % self.output_filename)
+            lines.extend("    " + line for line in tail)
+        return "\n".join(lines)
+
+class CommandFailed(Exception):
+    def __init__(self, command, returncode, output):
+        self.command = command
+        self.returncode = returncode
+        self.output = output
+        Exception.__init__(self, "%s failed with %s" % (" ".join(command), describe_returncode(returncode)))
+
+    def describe(self):
+        lines = [str(self)]
+        lines.extend("    " + line for line in tail_lines(self.output))
+        return "\n".join(lines)
+
+class Supervisor(object):
+    def __init__(self):
+        self.children = []
+        self.read_fd, self.write_fd = os.pipe()
+        set_nonblocking(self.read_fd)
+        set_nonblocking(self.write_fd)
+
+        signal.signal(signal.SIGCHLD, self._on_sigchld)
+        # Restart interrupted system calls, only select() needs to wake up.
+        signal.siginterrupt(signal.SIGCHLD, False)
+
+    def _on_sigchld(self, signum, frame):
+        try:
+            os.write(self.write_fd, "x")
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def fileno(self):
+        """Readable whenever a child has exited."""
+        return self.read_fd
+
+    def spawn(self, name, command, output_filename, **kwargs):
+        child = Child(name, command, output_filename, **kwargs)
+        self.children.append(child)
+        return child
+
+    def run(self, command, **kwargs):
+        """Run command to completion, raising CommandFailed with its output if it fails."""
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=True, **kwargs)
+        output = process.communicate()[0]
+        if process.returncode != 0:
+            raise CommandFailed(command, process.returncode, output)
+        return output
+
+    def reap(self):
+        """Reap every child which has exited, and forget about it."""
+        self.children = [child for child in self.children if child.poll() is None]
+
+_supervisor = None
+
+def get_supervisor():
+    """The process wide Supervisor, there can only be one SIGCHLD handler."""
+    global _supervisor
+    if _supervisor is None:
+        _supervisor = Supervisor()
+    return _supervisor
@@ -0,0 +1,74 @@
+"""Minimal templating for nginx configs, without a dependency on a real engine.
+
+A template is split once into literal text and {placeholder} segments, so
+rendering is a single join no matter how many replacements there are.
+Placeholders without a replacement are left as they are, since nginx
+configs are full of braces.
+"""
+from __future__ import with_statement
+
+import os
+import re
+import tempfile
+
+PLACEHOLDER = re.compile(r"\{([A-Za-z0-9_.:\-]+)\}")
+
+class CompiledTemplate(object):
+    def __init__(self, text):
+        # Even indexes are literal text, odd indexes placeholder names.
+        self.segments = PLACEHOLDER.split(text)
+
+    def render(self, replacements):
+        parts = list(self.segments)
+        for index in xrange(1, len(parts), 2):
+            key = parts[index]
+            parts[index] = replacements.get(key, "{%s}" % key)
+        return "".join(parts)
+
+_cache = {}
+
+def load_template(filename):
+    """CompiledTemplate for filename, only re-read when the file changes."""
+    stat = os.stat(filename)
+    key = (stat.st_mtime, stat.st_size, stat.st_ino)
+
+    cached = _cache.get(filename)
+    if cached and cached[0] == key:
+        return cached[1]
+
+    with file(filename, 'r') as template_file:
+        template = CompiledTemplate(template_file.read())
+    _cache[filename] = (key, template)
+    return template
+
+def write_atomic(filename, content, mode=0644):
+    """Replace filename with content, so readers only ever see the old or the
+    new file in full. Returns False, without writing, if filename already
+    holds exactly content."""
+    try:
+        with file(filename, 'rb') as current:
+            if current.read() == content:
+                return False
+    except (IOError, OSError):
+        pass
+
+    dirname, basename = os.path.split(filename)
+    fd, temp_filename = tempfile.mkstemp(prefix="." + basename + ".", dir=dirname)
+    try:
+        os.fchmod(fd, mode)
+        with os.fdopen(fd, 'wb') as temp_file:
+            temp_file.write(content)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.rename(temp_filename, filename)
+    except:
+        os.unlink(temp_filename)
+        raise
+
+    # Make the rename itself durable.
+    dir_fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+    return True
@@ -0,0 +1,138 @@
+"""Warm up a freshly started service before nginx sends it real traffic.
+
+A service can be listening long before it serves at full speed (JIT
+compilation, cold caches, lazily opened connections). A warmup replays a
+list of URLs against the new instance, in rounds, until a round meets the
+latency target.
+"""
+
+from __future__ import with_statement
+
+import httplib
+import Queue
+import socket
+import threading
+import time
+
+from zdd.stats import percentile
+
+DEFAULT_REQUESTS = 100
+DEFAULT_CONCURRENCY = 4
+DEFAULT_PERCENTILE = 95.0
+DEFAULT_TIMEOUT = 60.0
+REQUEST_TIMEOUT = 10.0
+
+class WarmupError(Exception):
+    pass
+
+class WarmupRound(object):
+    def __init__(self, latencies, bad_statuses):
+        self.latencies = latencies
+        self.bad_statuses = bad_statuses
+
+    def latency(self, pct):
+        return percentile(self.latencies, pct)
+
+class Warmup(object):
+    def __init__(self, urls, requests=DEFAULT_REQUESTS, concurrency=DEFAULT_CONCURRENCY,
+                 max_latency=None, pct=DEFAULT_PERCENTILE, statuses=(200,), timeout=DEFAULT_TIMEOUT):
+        self.urls = urls
+        self.requests = requests
+        self.concurrency = concurrency
+        self.max_latency = max_latency
+        self.pct = pct
+        self.statuses = statuses
+        self.timeout = timeout
+
+    @classmethod
+    def from_config(cls, config, section):
+        """Build a Warmup from a [service:*] section, or None if warmup_urls isn't set."""
+        urls = config.get_default(section, "warmup_urls")
+        if not urls:
+            return None
+
+        max_latency = config.getfloat_default(section, "warmup_latency")
+        statuses = config.get_default(section, "warmup_status", "200")
+        return cls(
+            urls.split(),
+            requests=int(config.get_default(section, "warmup_requests", DEFAULT_REQUESTS)),
+            concurrency=int(config.get_default(section, "warmup_concurrency", DEFAULT_CONCURRENCY)),
+            max_latency=max_latency / 1000.0 if max_latency is not None else None,
+            pct=config.getfloat_default(section, "warmup_percentile", DEFAULT_PERCENTILE),
+            statuses=tuple(int(status) for status in statuses.split()),
+            timeout=config.getfloat_default(section, "warmup_timeout", DEFAULT_TIMEOUT),
+        )
+
+    def request(self, port, url):
+        """GET url from port. Returns (seconds taken, status), status is None on connection errors."""
+        start = time.time()
+        connection = httplib.HTTPConnection("127.0.0.1", port, timeout=REQUEST_TIMEOUT)
+        try:
+            try:
+                connection.request("GET", url)
+                response = connection.getresponse()
+                response.read()
+                status = response.status
+            except (socket.error, httplib.HTTPException):
+                status = None
+        finally:
+            connection.close()
+        return time.time() - start, status
+
+    def run_round(self, port):
+        jobs = Queue.Queue()
+        for index in xrange(self.requests):
+            jobs.put(self.urls[index % len(self.urls)])
+
+        latencies = []
+        bad_statuses = []
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                try:
+                    url = jobs.get_nowait()
+                except Queue.Empty:
+                    return
+                latency, status = self.request(port, url)
+                with lock:
+                    latencies.append(latency)
+                    if status not in self.statuses:
+                        bad_statuses.append((url, status))
+
+        threads = [threading.Thread(target=worker) for _ in xrange(min(self.concurrency, self.requests))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return WarmupRound(latencies, bad_statuses)
+
+    def is_warm(self, warmup_round):
+        if warmup_round.bad_statuses:
+            return False
+        if self.max_latency is None:
+            return True
+        return warmup_round.latency(self.pct) <= self.max_latency
+
+    def run(self, port):
+        """Send rounds of requests to port until one meets the target.
+
+        Returns the successful WarmupRound, raises WarmupError if no round
+        meets the target within the timeout.
+        """
+        deadline = time.time() + self.timeout
+        rounds = 0
+        while True:
+            warmup_round = self.run_round(port)
+            rounds += 1
+            if self.is_warm(warmup_round):
+                return warmup_round
+
+            if time.time() >= deadline:
+                if warmup_round.bad_statuses:
+                    url, status = warmup_round.bad_statuses[0]
+                    reason = "%d bad responses, first was %s for %s" % (len(warmup_round.bad_statuses), status or "connection error", url)
+                else:
+                    reason = "p%g latency %.1fms, target %.1fms" % (self.pct, warmup_round.latency(self.pct) * 1000, self.max_latency * 1000)
+                raise WarmupError("Not warm after %d rounds in %ss: %s" % (rounds, self.timeout, reason))